@@ -10,11 +10,12 @@ must install dash-bootstrap-components >= 0.11.0.
 For more details on building multi-page Dash applications, check out the Dash documentation: https://dash.plot.ly/urls
 """
 import os
+import secrets
 import arrow
 
 import dash
 import dash_bootstrap_components as dbc
-from dash import Input, Output, dcc, html, Dash
+from dash import Input, Output, dcc, html, Dash, DiskcacheManager
 import dash_mantine_components as dmc
 import dash_auth
 import asyncio
@@ -34,6 +35,8 @@ import emcommon.util as emcu
 from utils.datetime_utils import iso_to_date_only
 from utils.db_utils import df_to_filtered_records, query_users, query_confirmed_trips, query_demographics
 from utils.permissions import has_permission, config
+from utils.export_utils import export_blueprint
+from utils.cache_utils import get_disk_cache
 import flask_talisman as flt
 
 
@@ -52,20 +55,18 @@ elif auth_type == 'basic':
             'hello': 'world'
         }
 
-# # diskcache manager; required for 'background' callbacks
-# # https: // dash.plotly.com/background-callbacks
-# import diskcache
-
-# cache = diskcache.Cache("./cache")
-# background_callback_manager = DiskcacheLongCallbackManager(cache)
+# diskcache manager; required for 'background' callbacks
+# https: // dash.plotly.com/background-callbacks
+background_callback_manager = DiskcacheManager(get_disk_cache('background_callbacks'))
 
 app = Dash(
     external_stylesheets=[dbc.themes.BOOTSTRAP, dbc.icons.FONT_AWESOME],
     suppress_callback_exceptions=True,
     use_pages=True,
-    # background_callback_manager=background_callback_manager
+    background_callback_manager=background_callback_manager
 )
 server = app.server  # expose server variable for Procfile
+server.register_blueprint(export_blueprint)  # streamed exports of the data tables
 
 if auth_type == 'basic':
     auth = dash_auth.BasicAuth(
@@ -244,12 +245,12 @@ page_content = dcc.Loading(
 
 @app.callback(
     Output('global-loading', 'display'),
-    Input('interval-load-more', 'disabled'),
+    Input('uuids-stats-loading', 'data'),
 )
-def hide_spinner_while_loading_batch(interval_disabled):
-    if interval_disabled:
-        return 'auto'
-    return 'hide'
+def hide_spinner_while_loading_batch(loading):
+    if loading:
+        return 'hide'
+    return 'auto'
 
 
 def make_home_page(): return [
@@ -304,7 +305,8 @@ def update_store_uuids(start_date, end_date, timezone, excluded_subgroups):
     (start_date, end_date) = iso_to_date_only(start_date, end_date)
     users_df = query_users()
     if users_df.empty:
-        return {"data": [], "length": 0}, {"data": [], "length": 0}
+        return ({"data": [], "length": 0, "version": secrets.token_hex(8)},
+                {"data": [], "length": 0, "version": secrets.token_hex(8)})
     
     # if any subgroups are excluded, find UUIDs in those subgroups and output
     # a list to store-excluded-uuids so that other callbacks can exclude them too
@@ -314,13 +316,17 @@ def update_store_uuids(start_date, end_date, timezone, excluded_subgroups):
         excluded_uuids_list.extend(uuids_in_subgroup)
 
     records = df_to_filtered_records(users_df, 'user_id', excluded_uuids_list)
+    # Each store has a version, set whenever it is loaded, so that the pages
+    # can tell whether it changed without comparing its data
     store_uuids = {
         "data": records,
         "length": len(records),
+        "version": secrets.token_hex(8),
     }
     store_excluded_uuids = {
         "data": excluded_uuids_list,
         "length": len(excluded_uuids_list),
+        "version": secrets.token_hex(8),
     }
     return store_uuids, store_excluded_uuids
 
@@ -340,6 +346,7 @@ def update_store_demographics(start_date, end_date, timezone, excluded_uuids):
     store = {
         "data": records,
         "length": len(records),
+        "version": secrets.token_hex(8),
     }
     return store
 
@@ -360,7 +367,8 @@ def update_store_trips(start_date, end_date, timezone, excluded_uuids):
     store = {
         "data": records,
         "length": len(records),
-        "userinputcols": user_input_cols
+        "userinputcols": user_input_cols,
+        "version": secrets.token_hex(8),
     }
     return store
 
@@ -4,10 +4,15 @@ Note that the callback will trigger even if prevent_initial_call=True. This is b
 Since the dcc.Location component is not in the layout when navigating to this page, it triggers the callback.
 The workaround is to check if the input value is None.
 """
-from dash import dcc, html, Input, Output, callback, register_page, State, set_props, MATCH
+from dash import dcc, html, Input, Output, callback, register_page, State, set_props, MATCH, get_relative_path, \
+    callback_context, no_update, clientside_callback
 import dash_ag_grid as dag
+import dash_bootstrap_components as dbc
 import arrow
+import hashlib
+import json
 import logging
+import numpy as np
 import pandas as pd
 from dash.exceptions import PreventUpdate
 
@@ -15,13 +20,39 @@ from utils import constants
 from utils import permissions as perm_utils
 from utils import db_utils
 from utils.db_utils import df_to_filtered_records, query_trajectories
+from utils.grid_utils import register_frame, update_frame, get_frame, get_rows_block, GRID_BLOCK_SIZE, \
+    GRID_FRAME_EXPIRED_MESSAGE
+from utils.cache_utils import LRUCache
+from utils.export_utils import get_export_href
 from utils.datetime_utils import iso_to_date_only
 import emission.core.timer as ect
 import emission.storage.decorations.stats_queries as esdsq
 from utils.ux_utils import skeleton
-from utils.datetime_utils import ts_to_iso
+from utils.datetime_utils import ts_series_to_iso
 register_page(__name__, path="/data")
 
+# Inputs of render_content that each tab is rendered from. A tab is only
+# rendered again when one of its own inputs changes.
+TAB_INPUTS = {
+    'tab-uuids-datatable': ['store-uuids'],
+    'tab-trips-datatable': ['store-uuids', 'store-trips'],
+    'tab-demographics-datatable': ['store-uuids', 'store-demographics'],
+    'tab-trajectories-datatable': ['store-uuids', 'store-excluded-uuids', 'store-trajectories',
+                                   'date-picker', 'date-picker-timezone', 'keylist-switch'],
+}
+# Rendered tabs keyed by a hash of their inputs, so that switching back to a
+# tab whose data has not changed reuses its content. The UUIDs tab is not
+# cached since its rows are loaded in batches after it is rendered, nor the
+# Trajectories tab, which queries its data itself when it is rendered and
+# would otherwise miss the trajectories recorded since.
+_rendered_tabs = LRUCache(maxsize=8)
+UNCACHED_TABS = {'tab-uuids-datatable', 'tab-trajectories-datatable'}
+
+# Number of users whose trip stats are queried at a time for the UUIDs tab;
+# the first batch is shown right away and each next one is loaded once the
+# grid has been refreshed with the previous one
+UUIDS_STATS_BATCH_SIZE = 100
+
 intro = """## Data"""
 
 layout = html.Div(
@@ -33,10 +64,18 @@ layout = html.Div(
             dcc.Tab(label='Demographics', value='tab-demographics-datatable'),
             dcc.Tab(label='Trajectories', value='tab-trajectories-datatable'),
         ]),
+        html.Div(
+            id='uuids-stats-progress-container',
+            children=dbc.Progress(id='uuids-stats-progress', value=0, striped=True, animated=True),
+            style={'display': 'none'},
+        ),
         html.Div(id='tabs-content', style={'margin': '12px '}),
         dcc.Store(id='selected-tab', data='tab-uuids-datatable'),  # Store to hold selected tab
-        dcc.Store(id='loaded-uuids-stats', data=[]),
-        dcc.Store(id='all-uuids-stats-loaded', data=False),
+        # progress of the batch loading of the UUIDs tab: the key of the
+        # grid frame the batches are appended to, and the number of users loaded
+        dcc.Store(id='loaded-uuids-stats', data={}),
+        dcc.Store(id='uuids-stats-loading', data=False),
+        dcc.Store(id='uuids-grid-refreshed'),
         # RadioItems for key list switch, wrapped in a div that can hide/show
         html.Div(
             id='keylist-switch-container',
@@ -58,13 +97,61 @@ layout = html.Div(
 )
 
 
+def format_coordinates(coordinates: pd.Series):
+    """
+    Format a series of [lon, lat] coordinates as '(lon, lat)' strings,
+    leaving entries that are not coordinates as they are
+    """
+    is_point = coordinates.map(lambda c: isinstance(c, (list, tuple)) and len(c) >= 2).to_numpy(dtype=bool)
+    if not is_point.any():
+        return coordinates
+    points = np.array([c[:2] for c in coordinates[is_point]], dtype=float)
+    formatted = coordinates.astype(object).copy()
+    formatted[is_point] = np.char.add(
+        np.char.add('(', points[:, 0].astype(str)),
+        np.char.add(np.char.add(', ', points[:, 1].astype(str)), ')'),
+    )
+    return formatted
+
+
+def format_percent(fractions: pd.Series):
+    """
+    Format a series of fractions as percentages with one decimal, e.g. '12.5%'
+    """
+    values = np.char.mod('%.1f%%', pd.to_numeric(fractions, errors='coerce').to_numpy(dtype=float) * 100)
+    return pd.Series(values, index=fractions.index, dtype=object)
+
+
+def get_uuids_batch_df(users_records):
+    """
+    Return the rows of the UUIDs table for a batch of users, with their
+    trip stats and formatted timestamps
+    """
+    users_df = pd.DataFrame(users_records)
+    stats_df = db_utils.query_users_stats(users_df['user_id'].tolist())
+    # the stats replace the counts stored in the users' profiles
+    users_df = users_df.drop(columns=[c for c in stats_df.columns if c != 'user_id' and c in users_df.columns])
+    users_df = users_df.merge(stats_df, on='user_id', how='left')
+
+    users_df = users_df[[c for c in perm_utils.column_plan.uuids_columns if c in users_df.columns]]
+    for col in users_df.columns:
+        if col.endswith('_ts'):
+            users_df[col] = ts_series_to_iso(users_df[col])
+
+    if 'total_trips' in users_df.columns and 'labeled_trips' in users_df.columns:
+        loc = users_df.columns.get_loc('labeled_trips') + 1
+        pct = (users_df['labeled_trips'] / users_df['total_trips'])
+        users_df.insert(loc, 'labeled_trips_pct', format_percent(pct))
+    return users_df
+
+
 def clean_location_data(df):
     with ect.Timer() as total_timer:
 
         # Stage 1: Clean start location coordinates
         if 'data.start_loc.coordinates' in df.columns:
             with ect.Timer() as stage1_timer:
-                df['data.start_loc.coordinates'] = df['data.start_loc.coordinates'].apply(lambda x: f'({x[0]}, {x[1]})')
+                df['data.start_loc.coordinates'] = format_coordinates(df['data.start_loc.coordinates'])
             esdsq.store_dashboard_time(
                 "admin/data/clean_location_data/clean_start_loc_coordinates",
                 stage1_timer
@@ -73,7 +160,7 @@ def clean_location_data(df):
         # Stage 2: Clean end location coordinates
         if 'data.end_loc.coordinates' in df.columns:
             with ect.Timer() as stage2_timer:
-                df['data.end_loc.coordinates'] = df['data.end_loc.coordinates'].apply(lambda x: f'({x[0]}, {x[1]})')
+                df['data.end_loc.coordinates'] = format_coordinates(df['data.end_loc.coordinates'])
             esdsq.store_dashboard_time(
                 "admin/data/clean_location_data/clean_end_loc_coordinates",
                 stage2_timer
@@ -148,6 +235,64 @@ def show_keylist_switch(tab):
     Input('keylist-switch', 'value'),  # Add keylist-switch to trigger data refresh on change
 )
 def render_content(tab, store_uuids, store_excluded_uuids, store_trips, store_demographics, store_trajectories, start_date, end_date, timezone, key_list):
+    inputs = {
+        'store-uuids': store_uuids,
+        'store-excluded-uuids': store_excluded_uuids,
+        'store-trips': store_trips,
+        'store-demographics': store_demographics,
+        'store-trajectories': store_trajectories,
+        'date-picker': [start_date, end_date],
+        'date-picker-timezone': timezone,
+        'keylist-switch': key_list,
+    }
+    used_inputs = TAB_INPUTS.get(tab, [])
+    # Updates of inputs that the selected tab does not use leave it as it is
+    triggered = set(callback_context.triggered_prop_ids.values())
+    if triggered and 'tabs-datatable' not in triggered and triggered.isdisjoint(used_inputs):
+        logging.debug(f"Callback - {tab} inputs unchanged, keeping the rendered tab.")
+        return no_update
+
+    render_key = get_render_key(tab, [inputs[input_id] for input_id in used_inputs])
+    cached = _rendered_tabs.get(render_key) if tab not in UNCACHED_TABS else None
+    # the grids of a cached tab fetch their rows from frames held by
+    # grid_utils, which may have been evicted since
+    if cached is not None and all(get_frame(frame_key) is not None for frame_key in cached['frame_keys']):
+        logging.debug(f"Callback - {tab} rendering reused.")
+        return cached['content']
+
+    content = render_tab(tab, store_uuids, store_excluded_uuids, store_trips, store_demographics, store_trajectories, start_date, end_date, timezone, key_list)
+    if tab not in UNCACHED_TABS:
+        _rendered_tabs.set(render_key, {'content': content, 'frame_keys': get_frame_keys(content)})
+    return content
+
+
+def get_render_key(tab, used_values):
+    """
+    Return a hash of the inputs a tab is rendered from. The data stores are
+    hashed by their length and version rather than their data.
+    """
+    used_values = [
+        [value.get('length'), value['version']] if isinstance(value, dict) and 'version' in value else value
+        for value in used_values
+    ]
+    digest = hashlib.sha1(tab.encode())
+    digest.update(json.dumps(used_values, default=str).encode())
+    return digest.hexdigest()
+
+
+def get_frame_keys(content):
+    """
+    Return the keys of the grid frames registered for the tables in content
+    """
+    if content is None or not hasattr(content, '_traverse'):
+        return []
+    return [
+        component.data for component in content._traverse()
+        if isinstance(getattr(component, 'id', None), dict) and component.id.get('type') == 'data_table_frame'
+    ]
+
+
+def render_tab(tab, store_uuids, store_excluded_uuids, store_trips, store_demographics, store_trajectories, start_date, end_date, timezone, key_list):
     with ect.Timer() as total_timer:
         # Stage 1: Update selected tab
         selected_tab = tab
@@ -160,27 +305,27 @@ def render_content(tab, store_uuids, store_excluded_uuids, store_trips, store_de
         if tab == 'tab-uuids-datatable':
             with ect.Timer() as handle_uuids_timer:
                 # Prepare the data to be displayed
-                columns = perm_utils.get_uuids_columns()  # Get the relevant columns
-                users_df = pd.DataFrame(store_uuids['data'])
+                users = store_uuids.get('data', [])
 
-                if users_df.empty or not perm_utils.has_permission('data_uuids'):
+                if not users or not perm_utils.has_permission('data_uuids'):
                     logging.debug(f"Callback - {selected_tab} insufficient permission.")
                     content = html.Div([html.P("No data available or you don't have permission.")])
                 else:
-                    users_df = users_df[[c for c in columns if c in users_df.columns]]
-                    for col in users_df.columns:
-                        if col.endswith('_ts'):
-                            users_df[col] = users_df[col].apply(ts_to_iso)
-
-                    if 'total_trips' in users_df.columns and 'labeled_trips' in users_df.columns:
-                        loc = users_df.columns.get_loc('labeled_trips') + 1
-                        pct = (users_df['labeled_trips'] / users_df['total_trips'])
-                        users_df.insert(loc, 'labeled_trips_pct', pct.apply(lambda x: f"{x:.1%}"))
+                    # Show the first batch of users now; load_more_uuids_stats
+                    # appends the others to the same grid frame
+                    users_df = get_uuids_batch_df(users[:UUIDS_STATS_BATCH_SIZE])
+                    datatable = populate_datatable(users_df, store_uuids, 'uuids')
+                    loaded = min(UUIDS_STATS_BATCH_SIZE, len(users))
+                    set_props('loaded-uuids-stats', {'data': {
+                        'frame_key': get_frame_keys(datatable)[0],
+                        'loaded': loaded,
+                    }})
+                    set_props('uuids-stats-loading', {'data': loaded < len(users)})
 
                     logging.debug(f"Callback - {selected_tab} Stage 5: Returning appended data to update the UI.")
                     content = html.Div([
-                        populate_datatable(users_df, store_uuids, 'uuids'),
-                        html.P(f"Showing {len(store_uuids['data'])} UUIDs.",
+                        datatable,
+                        html.P(f"Showing {len(users)} UUIDs.",
                                 style={'margin': '15px 5px'})
                     ])
 
@@ -196,8 +341,7 @@ def render_content(tab, store_uuids, store_excluded_uuids, store_trips, store_de
                 logging.debug(f"Callback - {selected_tab} Stage 2: Handling Trips tab.")
 
                 data = store_trips.get("data", [])
-                columns = perm_utils.get_allowed_trip_columns()
-                columns.extend(store_trips.get("userinputcols", []))
+                columns = perm_utils.column_plan.allowed_trip_columns_set.union(store_trips.get("userinputcols", []))
                 has_perm = perm_utils.has_permission('data_trips')
 
                 df = pd.DataFrame(data)
@@ -273,8 +417,7 @@ def render_content(tab, store_uuids, store_excluded_uuids, store_trips, store_de
                     store_trajectories = update_store_trajectories(start_date, end_date, timezone, store_excluded_uuids, key_list)
                 data = store_trajectories["data"]
                 if data:
-                    columns = list(data[0].keys())
-                    columns = perm_utils.get_trajectories_columns(columns)
+                    columns = set(perm_utils.get_trajectories_columns(data[0].keys()))
                     has_perm = perm_utils.has_permission('data_trajectories')
 
                     df = pd.DataFrame(data)
@@ -417,9 +560,27 @@ def update_raw_vs_humanized_units(n_clicks, columnDefs):
     return columnDefs, button_label
 
 
+def prepare_grid_frame(df, store_uuids):
+    """
+    Add the user tokens next to the user ids of df and rename its columns
+    for AG Grid, which does not allow . in column names
+    """
+    if 'user_token' not in df.columns:
+        uuids_df = pd.DataFrame(store_uuids['data'])
+        user_id_col = 'data.user_id' if 'data.user_id' in df.columns else 'user_id'
+        if user_id_col in df.columns:
+            user_id_token_map = uuids_df.set_index('user_id')['user_token'].to_dict()
+            df.insert(
+                df.columns.get_loc(user_id_col),
+                'user_token',
+                df[user_id_col].map(user_id_token_map)
+            )
+    df.columns = [col.replace('.', '_') for col in df.columns]
+    return df
+
+
 def populate_datatable(df, store_uuids, table_id):
     with ect.Timer() as total_timer:
-        df.fillna("N/A", inplace=True)
         # Stage 1: Check if df is a DataFrame and raise PreventUpdate if not
         with ect.Timer() as stage1_timer:
             if not isinstance(df, pd.DataFrame):
@@ -428,31 +589,30 @@ def populate_datatable(df, store_uuids, table_id):
             "admin/data/populate_datatable/check_dataframe_type",
             stage1_timer
         )
-        if 'user_token' not in df.columns:
-            uuids_df = pd.DataFrame(store_uuids['data'])
-            user_id_col = 'data.user_id' if 'data.user_id' in df.columns else 'user_id'
-            if user_id_col in df.columns:
-                user_id_token_map = uuids_df.set_index('user_id')['user_token'].to_dict()
-                df.insert(
-                    df.columns.get_loc(user_id_col),
-                    'user_token',
-                    df[user_id_col].map(user_id_token_map)
-                )
         # Stage 2: Create the DataTable from the DataFrame
         with ect.Timer() as stage2_timer:
-            # Ag Grid does not allow . in column names; replace with _
-            # before creating the DataTable
-            df.columns = [col.replace('.', '_') for col in df.columns]
+            df = prepare_grid_frame(df, store_uuids)
+            # The grid fetches rows block by block from the frame kept on the
+            # server (see serve_table_rows), so only the visible rows are sent
+            frame_key = register_frame(df)
             result = html.Div([
+              dbc.Alert(GRID_FRAME_EXPIRED_MESSAGE, id={'type': 'data_table_expired', 'id': table_id},
+                        color='warning', is_open=False),
               dag.AgGrid(
                 id={'type': 'data_table', 'id': table_id},
-                rowData=df.to_dict('records'),
-                columnDefs=[{"field": i, "headerName": i} for i in df.columns],
+                rowModelType="infinite",
+                columnDefs=[
+                    {"field": i, "headerName": i, "filter": "agNumberColumnFilter"}
+                    if pd.api.types.is_numeric_dtype(df[i]) and not pd.api.types.is_bool_dtype(df[i])
+                    else {"field": i, "headerName": i}
+                    for i in df.columns
+                ],
                 defaultColDef={ "sortable": True, "filter": True },
                 columnSize="autoSize",
                 dashGridOptions={
                     "pagination": True,
                     "paginationPageSize": 50,
+                    "cacheBlockSize": GRID_BLOCK_SIZE,
                     "enableCellTextSelection": True,
                 },
                 style={
@@ -460,10 +620,11 @@ def populate_datatable(df, store_uuids, table_id):
                     "height": "600px",
                 },
               ),
-              html.Button(
-                  "Download CSV",
-                  id={"type": "download-csv-btn", "id": table_id},
-              ),
+              dcc.Store(id={'type': 'data_table_frame', 'id': table_id}, data=frame_key),
+              html.Div([
+                  create_download_link(frame_key, table_id, 'csv', "Download CSV"),
+                  create_download_link(frame_key, table_id, 'parquet', "Download Parquet"),
+              ], style={'display': 'flex', 'gap': '5px'}),
             ])
         esdsq.store_dashboard_time(
             "admin/data/populate_datatable/create_datatable",
@@ -478,13 +639,126 @@ def populate_datatable(df, store_uuids, table_id):
 
 
 @callback(
-    Output({"type": "data_table", "id": MATCH}, "exportDataAsCsv"),
-    Output({"type": "download-csv-btn", "id": MATCH}, "csvExportParams"),
-    Output({"type": "download-csv-btn", "id": MATCH}, "n_clicks"),
-    Input({"type": "download-csv-btn", "id": MATCH}, "n_clicks"),
+    Output({'type': 'data_table', 'id': MATCH}, 'getRowsResponse'),
+    Output({'type': 'data_table_expired', 'id': MATCH}, 'is_open'),
+    Input({'type': 'data_table', 'id': MATCH}, 'getRowsRequest'),
+    State({'type': 'data_table_frame', 'id': MATCH}, 'data'),
 )
-def export_table_as_csv(n_clicks):
-    if not n_clicks:
+def serve_table_rows(request, frame_key):
+    if not request:
         raise PreventUpdate
-    return True, {"fileName": "tokens-table.csv"}, 0
+    with ect.Timer() as total_timer:
+        response = get_rows_block(frame_key, request)
+    esdsq.store_dashboard_time(
+        "admin/data/serve_table_rows/total_time",
+        total_timer
+    )
+    if response is None:
+        return {'rowData': [], 'rowCount': 0}, True
+    return response, False
+
+
+# Batches are chained: each one is loaded after the grid has been refreshed
+# with the previous one, so a batch is never requested while another one is
+# still being loaded
+@callback(
+    Output('loaded-uuids-stats', 'data'),
+    Output('uuids-stats-loading', 'data'),
+    Input('uuids-grid-refreshed', 'data'),
+    State('loaded-uuids-stats', 'data'),
+    State('uuids-stats-loading', 'data'),
+    State('store-uuids', 'data'),
+    prevent_initial_call=True,
+)
+def load_more_uuids_stats(refreshed, loaded_stats, loading, store_uuids):
+    users = store_uuids.get('data', []) if store_uuids else []
+    if not loading:
+        return no_update, no_update
+    if not loaded_stats or get_frame(loaded_stats['frame_key']) is None:
+        # the frame was evicted, the grid has to be rendered again
+        return no_update, False
+    with ect.Timer() as total_timer:
+        start = loaded_stats['loaded']
+        batch = users[start:start + UUIDS_STATS_BATCH_SIZE]
+        if batch:
+            batch_df = prepare_grid_frame(get_uuids_batch_df(batch), store_uuids)
+            frame = get_frame(loaded_stats['frame_key'])
+            # a batch may be requested twice, so rows of users already
+            # loaded are replaced rather than appended again
+            frame = pd.concat([frame, batch_df], ignore_index=True)
+            if 'user_id' in frame.columns:
+                frame = frame.drop_duplicates('user_id', keep='last', ignore_index=True)
+            update_frame(loaded_stats['frame_key'], frame)
+        loaded = min(start + len(batch), len(users))
+        logging.debug(f"Loaded the trip stats of {loaded} of {len(users)} users")
+    esdsq.store_dashboard_time(
+        "admin/data/load_more_uuids_stats/total_time",
+        total_timer
+    )
+    return {**loaded_stats, 'loaded': loaded}, loaded < len(users)
 
+
+@callback(
+    Output('uuids-stats-progress-container', 'style'),
+    Output('uuids-stats-progress', 'value'),
+    Output('uuids-stats-progress', 'label'),
+    Input('loaded-uuids-stats', 'data'),
+    Input('uuids-stats-loading', 'data'),
+    State('store-uuids', 'data'),
+)
+def show_uuids_stats_progress(loaded_stats, loading, store_uuids):
+    total = len(store_uuids.get('data', [])) if store_uuids else 0
+    if not loading or not loaded_stats or not total:
+        return {'display': 'none'}, 0, None
+    loaded = loaded_stats['loaded']
+    return ({'margin': '0 12px'}, 100 * loaded / total,
+            f"Loading trip stats: {loaded} of {total} users")
+
+
+# The UUIDs grid fetches its rows from the server, so it has to be told to
+# fetch them again once a batch has been appended to its frame; this also
+# requests the next batch from load_more_uuids_stats
+clientside_callback(
+    """
+    function(loadedStats) {
+        if (loadedStats && loadedStats.loaded) {
+            try {
+                dash_ag_grid.getApi({'type': 'data_table', 'id': 'uuids'}).refreshInfiniteCache();
+            } catch (e) {
+                // the UUIDs tab is not displayed
+            }
+        }
+        return loadedStats;
+    }
+    """,
+    Output('uuids-grid-refreshed', 'data'),
+    Input('loaded-uuids-stats', 'data'),
+    prevent_initial_call=True,
+)
+
+
+def create_download_link(frame_key, table_id, file_format, label):
+    filename = f"{table_id}-table.{file_format}"
+    return html.A(
+        html.Button(label),
+        id={"type": f"download-{file_format}-link", "id": table_id},
+        href=get_relative_path(get_export_href(frame_key, filename)),
+        download=filename,
+    )
+
+
+# The exports are streamed by the server (see utils/export_utils.py), so the
+# links only need to follow the filters applied to the grid
+@callback(
+    Output({"type": "download-csv-link", "id": MATCH}, "href"),
+    Output({"type": "download-parquet-link", "id": MATCH}, "href"),
+    Input({"type": "data_table", "id": MATCH}, "filterModel"),
+    State({"type": "data_table_frame", "id": MATCH}, "data"),
+    State({"type": "data_table", "id": MATCH}, "id"),
+    prevent_initial_call=True,
+)
+def update_download_links(filter_model, frame_key, table):
+    return tuple(
+        get_relative_path(get_export_href(frame_key, f"{table['id']}-table.{file_format}", filter_model))
+        for file_format in ['csv', 'parquet']
+    )
@@ -13,7 +13,7 @@ import numpy as np
 import pandas as pd
 import plotly.graph_objects as go
 
-from dash import dcc, html, Input, Output, ALL, callback, register_page, callback_context
+from dash import dcc, html, Input, Output, State, ALL, callback, register_page, callback_context, no_update
 import dash_bootstrap_components as dbc
 from dash_iconify import DashIconify
 
@@ -23,26 +23,109 @@ import emcommon.bluetooth.ble_matching as emcble
 import emission.analysis.configs.dynamic_config as eacd
 
 from utils.permissions import has_permission
+from utils.columnar_utils import encode_array, decode_array, encode_categories, decode_categories, category_mask
+from utils.spatial_utils import coordinates_key, get_grid_index, get_point_clusters, \
+    viewport_from_relayout, sample_evenly, CLUSTER_MAX_ZOOM
 
 config = eacd.get_dynamic_config()
 ble_enabled = config.get('vehicle_identities')
 
+# Upper bounds on the number of trips sent to the browser for the visible
+# area; the lines map draws one trace per trip so it gets a lower bound
+MAX_VISIBLE_TRIPS = 10000
+MAX_VISIBLE_TRIP_LINES = 1000
+# Number of trips outside the visible area drawn as an overview
+OVERVIEW_SAMPLE_TRIPS = 500
+# The flows map snaps trip endpoints to the cluster grid this many zoom
+# levels coarser than the view (cells of 128px on screen), and draws the
+# largest flows only, with widths in a few buckets so that each mode
+# needs at most FLOW_WIDTH_BUCKETS traces
+FLOW_CELL_ZOOM_OFFSET = 2
+MAX_FLOWS = 300
+FLOW_WIDTH_BUCKETS = 6
+
+MODE_KEYS = ['mode_confirm', 'data.primary_sensed_mode', 'data.primary_ble_sensed_mode']
+# Trips are colored by the first of these modes that they have
+COLOR_MODE_KEYS = ['mode_confirm', 'data.primary_ble_sensed_mode', 'data.primary_sensed_mode']
+# Map filter dropdown ids and the mode they filter on
+MODE_FILTERS = {
+    'labeled_modes': 'mode_confirm',
+    'sensed_modes': 'data.primary_sensed_mode',
+    'ble_modes': 'data.primary_ble_sensed_mode',
+}
+
+
+def filter_trip_positions(map_trips, filter_dict):
+    """
+    Return the positions of the trips that match the selected values of every
+    map filter. Filters with no selected values do not filter anything.
+    """
+    mask = np.ones(map_trips['length'], dtype=bool)
+    for filter_id, mode_key in MODE_FILTERS.items():
+        selected_values = filter_dict.get(filter_id)
+        if selected_values:
+            if mode_key in map_trips['modes']:
+                mask &= category_mask(map_trips['modes'][mode_key], selected_values)
+            else:
+                mask[:] = False
+    selected_uuids = filter_dict.get('users')
+    if selected_uuids:
+        mask &= category_mask(map_trips['user_id'], selected_uuids)
+    return np.flatnonzero(mask)
 
-def filter_trips(trips, selected_values, trip_key):
+
+def get_endpoint_arrays(map_trips):
     """
-    Return a subset of trips where the value of trip.get(trip_key) is in
-    selected_values.
-    If selected_values is empty, return all trips
+    Return arrays of lon and lat for the trip endpoints, with the start and
+    end of trip i stored at positions 2*i and 2*i+1
     """
-    if not selected_values:
-        logging.info("No values selected => returning data unfiltered")
-        return trips
-    filtered_trips = []
-    for trip in trips:
-        value = trip.get(trip_key)
-        if value and value in selected_values:
-            filtered_trips.append(trip)
-    return filtered_trips
+    lon = np.empty(2 * map_trips['length'], dtype=float)
+    lat = np.empty(2 * map_trips['length'], dtype=float)
+    (lon[0::2], lat[0::2]) = (decode_array(map_trips['start_lon']), decode_array(map_trips['start_lat']))
+    (lon[1::2], lat[1::2]) = (decode_array(map_trips['end_lon']), decode_array(map_trips['end_lat']))
+    return lon, lat
+
+
+def get_trip_color_categories(map_trips):
+    """
+    Return, for each trip, the position in the returned modes and colors
+    lists of the mode it is colored by (labeled, then BLE sensed, then sensed
+    mode). Trips with none of those modes get the last position, which has
+    no color.
+    """
+    categories = np.full(map_trips['length'], -1, dtype=int)
+    (modes, colors) = ([], [])
+    for mode_key in COLOR_MODE_KEYS:
+        if mode_key not in map_trips['modes']:
+            continue
+        encoded = map_trips['modes'][mode_key]
+        (values, codes) = decode_categories(encoded)
+        unassigned = (categories < 0) & (codes >= 0)
+        categories[unassigned] = codes[unassigned] + len(modes)
+        modes.extend(values)
+        colors.extend(encoded['colors'])
+    categories[categories < 0] = len(modes)
+    return categories, modes + [None], colors + [None]
+
+
+def select_trips_in_viewport(positions, index, bounds, max_visible):
+    """
+    Return the positions of the trips to draw: trips with an endpoint in the
+    visible bounds (evenly sampled down to max_visible), plus a sampled
+    overview of the trips outside them so that the map keeps its context
+    when the user zooms back out.
+    If bounds is None, the whole map is visible.
+    """
+    positions = np.asarray(positions, dtype=int)
+    if bounds is None:
+        return sample_evenly(positions, max_visible)
+    trips_in_view = np.unique(index.query(*bounds) // 2)
+    in_view = np.intersect1d(positions, trips_in_view, assume_unique=True)
+    outside = np.setdiff1d(positions, in_view, assume_unique=True)
+    return np.union1d(
+        sample_evenly(in_view, max_visible),
+        sample_evenly(outside, OVERVIEW_SAMPLE_TRIPS),
+    )
 
 
 ################################################################################
@@ -63,7 +146,7 @@ def create_lines_map(coordinates):
                 lon=[coordinates['lon'][i], coordinates['lon'][i+1]],
                 lat=[coordinates['lat'][i], coordinates['lat'][i+1]],
                 marker={'size': 9, 'color': coordinates['color'][i]},
-                text=coordinates['text'],
+                text=coordinates['text'][i:i+2],
                 hoverinfo='text',
             )
         )
@@ -83,45 +166,61 @@ def create_lines_map(coordinates):
     return fig
 
 
-def get_start_and_end_hover_text(trip, map_type):
-    trip_info = {}
-    if map_type == 'lines':
-        if (has_permission('options_uuids') or has_permission('options_emails')):
-            trip_info['User'] = get_user_label(trip.get('user_id'))
-        trip_info['Distance (m)'] = round(trip.get('data.distance_meters', 0), 2)
-    
-    trip_info['Labeled Mode'] = trip.get('mode_confirm', 'Unlabeled')
-    trip_info['Sensed Mode'] = trip.get("data.primary_sensed_mode") or "None"
-    if ble_enabled:
-        trip_info['BLE Mode'] = trip.get("data.primary_ble_sensed_mode") or "None"
-    start_info = { 'Coordinates': f'{trip["start_coordinates"]}'} | trip_info
-    end_info = { 'Coordinates': f'{trip["end_coordinates"]}'} | trip_info
+def get_hover_texts(map_trips, positions, map_type):
+    """
+    Return the hover text for the start and end point of each of the trips
+    at positions, interleaved
+    """
+    decoded_modes = {mode_key: decode_categories(encoded) for mode_key, encoded in map_trips['modes'].items()}
+    def get_mode(mode_key, i):
+        if mode_key not in decoded_modes:
+            return None
+        (values, codes) = decoded_modes[mode_key]
+        return values[codes[i]] if codes[i] >= 0 else None
+
+    show_users = map_type == 'lines' and (has_permission('options_uuids') or has_permission('options_emails'))
+    if show_users:
+        (user_ids, user_codes) = decode_categories(map_trips['user_id'])
+        user_labels = {code: get_user_label(user_ids[code]) for code in set(user_codes[positions]) if code >= 0}
+    distances = decode_array(map_trips['distance'])
+    (lon, lat) = get_endpoint_arrays(map_trips)
     fmt_dict = lambda d: '<br>'.join([f'<b>{k}:</b> {v}' for k, v in d.items()])
-    return [fmt_dict(start_info), fmt_dict(end_info)]
 
-
-def get_map_coordinates(filtered_trips, map_type):
+    texts = []
+    for i in positions:
+        trip_info = {}
+        if map_type == 'lines':
+            if show_users:
+                trip_info['User'] = user_labels.get(user_codes[i], '')
+            trip_info['Distance (m)'] = round(float(np.nan_to_num(distances[i])), 2)
+        trip_info['Labeled Mode'] = get_mode('mode_confirm', i) or 'Unlabeled'
+        trip_info['Sensed Mode'] = get_mode('data.primary_sensed_mode', i) or "None"
+        if ble_enabled:
+            trip_info['BLE Mode'] = get_mode('data.primary_ble_sensed_mode', i) or "None"
+        for point in [2 * i, 2 * i + 1]:
+            coordinates = f'[{round(float(lon[point]), 6)}, {round(float(lat[point]), 6)}]'
+            texts.append(fmt_dict({'Coordinates': coordinates} | trip_info))
+    return texts
+
+
+def get_map_coordinates(map_trips, positions, map_type):
     """
     Build arrays of lat, lon, color, and text so that the bubble map can
-    display detailed hover info (including base BLE mode) for each start/end.
+    display detailed hover info (including base BLE mode) for each start/end
+    of the trips at positions.
     """
-    coordinates = {
-        'lat': [],
-        'lon': [],
-        'color': [],
-        'text': [],  # We'll store the hover text for each point here
+    positions = np.asarray(positions, dtype=int)
+    point_indices = np.empty(2 * len(positions), dtype=int)
+    (point_indices[0::2], point_indices[1::2]) = (2 * positions, 2 * positions + 1)
+    (lon, lat) = get_endpoint_arrays(map_trips)
+    (categories, _, colors) = get_trip_color_categories(map_trips)
+    return {
+        'lat': lat[point_indices].tolist(),
+        'lon': lon[point_indices].tolist(),
+        'color': [colors[c] for c in categories[point_indices // 2]],
+        'text': get_hover_texts(map_trips, positions, map_type),
     }
 
-    for trip in filtered_trips:
-        coordinates['lon'].extend([trip['start_coordinates'][0], trip['end_coordinates'][0]])
-        coordinates['lat'].extend([trip['start_coordinates'][1], trip['end_coordinates'][1]])
-        color = (trip.get('mode_confirm_color')
-                 or trip.get('data.primary_ble_sensed_mode_color')
-                 or trip.get('data.primary_sensed_mode_color'))
-        coordinates['color'].extend([color, color])
-        (start_hover_text, end_hover_text) = get_start_and_end_hover_text(trip, map_type)
-        coordinates['text'].extend([start_hover_text, end_hover_text])
-    return coordinates
 
 def create_heatmap_fig(coordinates):
     fig = go.Figure()
@@ -149,7 +248,7 @@ def create_heatmap_fig(coordinates):
 # derived from https://community.plotly.com/t/dynamic-zoom-for-mapbox/32658/12
 # workaround until dash team implements dynamic zoom on mapbox Scattermapbox and Densitymapbox
 def get_mapbox_zoom_and_center(coords):
-    if (not coords.get('lon') or not coords.get('lat') or len(coords['lon']) != len(coords['lat'])):
+    if (len(coords.get('lon', [])) == 0 or len(coords.get('lat', [])) == 0 or len(coords['lon']) != len(coords['lat'])):
         logging.error("Invalid input to get_mapbox_zoom_and_center, coords: " + str(coords))
         return 0, (0, 0)
     min_lonlat = (min(coords['lon']), min(coords['lat']))
@@ -193,6 +292,161 @@ def create_bubble_fig(coordinates):
     return fig
 
 
+def create_cluster_bubble_fig(map_trips, positions, index_key, bounds, zoom):
+    """
+    Draw the trip endpoints as clusters sized by their number of points and
+    colored by their dominant mode.
+    Returns None if the map is zoomed in far enough to draw individual points.
+    """
+    if zoom is not None and zoom >= CLUSTER_MAX_ZOOM:
+        return None
+    positions = np.asarray(positions, dtype=int)
+    point_indices = np.concatenate([2 * positions, 2 * positions + 1])
+    (trip_categories, modes, colors) = get_trip_color_categories(map_trips)
+    categories = trip_categories[point_indices // 2]
+
+    get_coordinates = lambda: get_endpoint_arrays(map_trips)
+    index = get_grid_index(index_key, get_coordinates)
+    if bounds is not None:
+        in_view = np.isin(point_indices, index.query(*bounds))
+        (point_indices, categories) = (point_indices[in_view], categories[in_view])
+    valid = np.isfinite(index.lon[point_indices]) & np.isfinite(index.lat[point_indices])
+    (point_indices, categories) = (point_indices[valid], categories[valid])
+    if len(point_indices) == 0:
+        return go.Figure()
+
+    coordinates = {'lon': index.lon[point_indices].tolist(), 'lat': index.lat[point_indices].tolist()}
+    (initial_zoom, center) = get_mapbox_zoom_and_center(coordinates)
+    if zoom is None:
+        zoom = initial_zoom
+        if zoom >= CLUSTER_MAX_ZOOM:
+            return None
+
+    clusters = get_point_clusters(index_key, get_coordinates).clusters(zoom, point_indices, categories)
+    logging.info(f"Drawing {len(point_indices)} points as {len(clusters['count'])} clusters at zoom {zoom}")
+    cluster_modes = [modes[c] for c in clusters['category']]
+    fig = go.Figure()
+    fig.add_trace(
+        go.Scattermapbox(
+            lat=clusters['lat'],
+            lon=clusters['lon'],
+            mode='markers+text',
+            marker=go.scattermapbox.Marker(
+                size=np.minimum(9 + 4 * np.sqrt(clusters['count'] - 1), 60),
+                color=[colors[c] for c in clusters['category']],
+                opacity=0.8,
+            ),
+            text=[str(count) if count > 1 else '' for count in clusters['count']],
+            hovertext=[f'<b>Points:</b> {count}<br><b>Most common mode:</b> {mode}'
+                       for count, mode in zip(clusters['count'], cluster_modes)],
+            hoverinfo='text',
+        )
+    )
+    fig.update_layout(
+        autosize=True,
+        mapbox_style='open-street-map',
+        mapbox_center_lon=center[0],
+        mapbox_center_lat=center[1],
+        mapbox_zoom=zoom,
+        mapbox_bearing=0,
+        margin={'r': 0, 't': 30, 'l': 0, 'b': 0},
+        height=650,
+    )
+    return fig
+
+
+def create_flows_fig(map_trips, positions, index_key, zoom):
+    """
+    Draw the largest origin-destination flows between grid cells, split by
+    mode, as lines whose width grows with their number of trips.
+    Returns the figure, the number of flows drawn and the number of trips
+    that start and end in the same cell (which have no line).
+    """
+    positions = np.asarray(positions, dtype=int)
+    get_coordinates = lambda: get_endpoint_arrays(map_trips)
+    index = get_grid_index(index_key, get_coordinates)
+    (starts, ends) = (2 * positions, 2 * positions + 1)
+    valid = (np.isfinite(index.lon[starts]) & np.isfinite(index.lat[starts])
+             & np.isfinite(index.lon[ends]) & np.isfinite(index.lat[ends]))
+    (positions, starts, ends) = (positions[valid], starts[valid], ends[valid])
+    if len(positions) == 0:
+        return go.Figure(), 0, 0
+
+    point_indices = np.concatenate([starts, ends])
+    coordinates = {'lon': index.lon[point_indices].tolist(), 'lat': index.lat[point_indices].tolist()}
+    (initial_zoom, center) = get_mapbox_zoom_and_center(coordinates)
+    if zoom is None:
+        zoom = initial_zoom
+    cell_zoom = max(int(zoom) - FLOW_CELL_ZOOM_OFFSET, 0)
+
+    clusters = get_point_clusters(index_key, get_coordinates)
+    (trip_categories, modes, colors) = get_trip_color_categories(map_trips)
+    trips_od = pd.DataFrame({
+        'origin': clusters.cells(cell_zoom, starts),
+        'destination': clusters.cells(cell_zoom, ends),
+        'category': trip_categories[positions],
+    })
+    local = trips_od['origin'] == trips_od['destination']
+    flows = (
+        trips_od[~local]
+        .groupby(['origin', 'destination', 'category'], sort=False)
+        .size()
+        .rename('count')
+        .reset_index()
+        .nlargest(MAX_FLOWS, 'count')
+    )
+    logging.info(f"Drawing {len(flows)} flows of {len(positions)} trips at cell zoom {cell_zoom}")
+
+    fig = go.Figure()
+    if len(flows):
+        (o_lon, o_lat) = clusters.cell_centers(cell_zoom, flows['origin'].to_numpy())
+        (d_lon, d_lat) = clusters.cell_centers(cell_zoom, flows['destination'].to_numpy())
+        counts = flows['count'].to_numpy()
+        buckets = np.ceil(counts / counts.max() * FLOW_WIDTH_BUCKETS).astype(int)
+        categories = flows['category'].to_numpy()
+        gaps = np.full(len(flows), np.nan)
+        for (category, bucket) in sorted(set(zip(categories, buckets))):
+            members = (categories == category) & (buckets == bucket)
+            # one trace per mode and width: flows separated by NaN gaps
+            fig.add_trace(
+                go.Scattermapbox(
+                    lon=np.column_stack([o_lon, d_lon, gaps])[members].ravel(),
+                    lat=np.column_stack([o_lat, d_lat, gaps])[members].ravel(),
+                    mode='lines',
+                    line={'width': 1.5 * bucket, 'color': colors[category]},
+                    opacity=0.7,
+                    hoverinfo='skip',
+                )
+            )
+        # lines have no hover of their own, so put it on the flow midpoints
+        fig.add_trace(
+            go.Scattermapbox(
+                lon=(o_lon + d_lon) / 2,
+                lat=(o_lat + d_lat) / 2,
+                mode='markers',
+                marker={'size': 6, 'color': [colors[c] for c in categories]},
+                hovertext=[
+                    f'<b>Trips:</b> {count}<br><b>Mode:</b> {modes[c] or "None"}'
+                    f'<br><b>From:</b> [{ox:.4f}, {oy:.4f}]<br><b>To:</b> [{dx:.4f}, {dy:.4f}]'
+                    for count, c, ox, oy, dx, dy in zip(counts, categories, o_lon, o_lat, d_lon, d_lat)
+                ],
+                hoverinfo='text',
+            )
+        )
+    fig.update_layout(
+        showlegend=False,
+        autosize=True,
+        mapbox_style='open-street-map',
+        mapbox_center_lon=center[0],
+        mapbox_center_lat=center[1],
+        mapbox_zoom=zoom,
+        mapbox_bearing=0,
+        margin={'r': 0, 't': 30, 'l': 0, 'b': 0},
+        height=650,
+    )
+    return fig, len(flows), int(local.sum())
+
+
 def create_single_option(value, color=None, label=None, icon=None):
     if icon:
         square = DashIconify(icon=f"mdi:{icon}", style={'margin': 'auto', 'color': color})
@@ -237,15 +491,9 @@ def get_user_label(user_id):
     return user_id if uuids_perm else ''
 
 
-def create_users_dropdown_options(trips):
+def create_users_dropdown_options(map_trips):
     options = []
-    unique_users = set()
-    for trip in trips:
-        user_id = trip.get('user_id')
-        if user_id:
-            unique_users.add(user_id)
-    options = []
-    for user_id in sorted(unique_users):
+    for user_id in map_trips['user_id']['values']:
         label = get_user_label(user_id)
         options.append(create_single_option(
             user_id,
@@ -254,20 +502,19 @@ def create_users_dropdown_options(trips):
     return options
 
 
-def create_modes_dropdown_options(trips, mode_key):
-    unique_modes = {}
-    for trip in trips:
-        mode = trip.get(mode_key)
-        if mode and mode not in unique_modes:
-            unique_modes[mode] = (trip[f'{mode_key}_color'], trip[f'{mode_key}_icon'])
+def create_modes_dropdown_options(map_trips, mode_key):
+    if mode_key not in map_trips['modes']:
+        return []
+    encoded = map_trips['modes'][mode_key]
     options = []
-    for mode in sorted(unique_modes.keys()):
-        options.append(create_single_option(
-            mode,
-            label=mode,
-            color=unique_modes[mode][0],
-            icon=unique_modes[mode][1],
-        ))
+    for (mode, color, icon) in zip(encoded['values'], encoded['colors'], encoded['icons']):
+        if mode:
+            options.append(create_single_option(
+                mode,
+                label=mode,
+                color=color,
+                icon=icon,
+            ))
     return options
 
 
@@ -278,11 +525,15 @@ if has_permission('map_bubble'):
     map_type_options.append({'label': 'Bubble Map', 'value': 'bubble'})
 if has_permission('map_trip_lines'):
     map_type_options.append({'label': 'Trips Lines', 'value': 'lines'})
+if has_permission('map_od_flows'):
+    map_type_options.append({'label': 'Origin-Destination Flows', 'value': 'flows'})
 
 
 layout = html.Div(
     [
-        dcc.Store(id="store-map-trips", data=[]),
+        dcc.Store(id="store-map-trips", data={}),  # column-wise; see store_map_trips
+        dcc.Store(id="store-map-index", data=None),  # key of the grid index over the trip endpoints
+        dcc.Store(id="store-map-viewport", data=None),
         dcc.Markdown(intro),
 
         dbc.Row([
@@ -306,7 +557,13 @@ layout = html.Div(
                 value=['bin'],
             )
         ),
-        dbc.Row(id="trip-map-row"),
+        dbc.Row(
+            [
+                dcc.Graph(id='trip-map-graph', figure=go.Figure(), style={'display': 'none'}),
+                html.Div(id='trip-map-message'),
+            ],
+            id="trip-map-row",
+        ),
     ],
     style={'display': 'flex', 'flex-direction': 'column', 'gap': 8}
 )
@@ -316,22 +573,24 @@ layout = html.Div(
     Input('map-type-dropdown', 'value'),
     Input('store-map-trips', 'data'),
 )
-def create_filters_dropdowns(map_type, trips):
+def create_filters_dropdowns(map_type, map_trips):
+    if not map_trips:
+        return []
     filters = []
 
-    labeled_modes_options = create_modes_dropdown_options(trips, 'mode_confirm')
+    labeled_modes_options = create_modes_dropdown_options(map_trips, 'mode_confirm')
     filters.append(('Labeled Modes', 'labeled_modes', labeled_modes_options))
 
-    sensed_modes_options = create_modes_dropdown_options(trips, 'data.primary_sensed_mode')
+    sensed_modes_options = create_modes_dropdown_options(map_trips, 'data.primary_sensed_mode')
     filters.append(('Sensed Modes', 'sensed_modes', sensed_modes_options))
 
     if config.get('vehicle_identities'):
-        ble_modes_options = create_modes_dropdown_options(trips, 'data.primary_ble_sensed_mode')
+        ble_modes_options = create_modes_dropdown_options(map_trips, 'data.primary_ble_sensed_mode')
         filters.append(('BLE Modes', 'ble_modes', ble_modes_options))
 
     uuids_perm, tokens_perm = has_permission('options_uuids'), has_permission('options_emails')
     if map_type == 'lines' and (uuids_perm or tokens_perm):
-        users_options = create_users_dropdown_options(trips)
+        users_options = create_users_dropdown_options(map_trips)
         filters.append(('Users', 'users', users_options))
 
     return [
@@ -354,45 +613,91 @@ def create_filters_dropdowns(map_type, trips):
 
 @callback(
     Output('store-map-trips', 'data'),
+    Output('store-map-index', 'data'),
     Input('store-trips', 'data'),
     Input('store-label-options', 'data'),
     Input('bin-other-labeled-modes', 'value'),
 )
 def store_map_trips(trips_data, label_options, bin_other_labels):
-    trips = trips_data['data']
-
-    for mode_key in ['mode_confirm', 'data.primary_sensed_mode', 'data.primary_ble_sensed_mode']:
-        modes_colors = {}
-        for trip in trips:
-            if mode_key in trip:
-                if mode_key == 'mode_confirm':
-                    if not trip[mode_key]:
-                        trip[mode_key] = 'unlabeled'
-                    elif bin_other_labels:
-                        mode_is_user_defined = trip[mode_key] and mode_key == 'mode_confirm' \
-                            and not any(mlo['value'] == trip[mode_key] for mlo in label_options['MODE'])
-                        if mode_is_user_defined:
-                            trip[mode_key] = 'other'
-                if trip[mode_key] not in modes_colors:
-                    rich_mode = emcdb.get_rich_mode_for_value(trip[mode_key], label_options)
-                    trip[f'{mode_key}_icon'] = rich_mode['icon']
-                    modes_colors[trip[mode_key]] = rich_mode['color']
+    """
+    Keep only the columns that the map needs, encoded column-wise:
+    endpoint coordinates and distances as float64 arrays (float32 would lose
+    the decimals shown on hover), and the modes and user ids
+    dictionary-encoded (with a color and icon per mode value)
+    """
+    trips = trips_data.get('data', [])
+    start = np.array([trip['start_coordinates'][:2] for trip in trips], dtype=float).reshape(-1, 2)
+    end = np.array([trip['end_coordinates'][:2] for trip in trips], dtype=float).reshape(-1, 2)
+    map_trips = {
+        'length': len(trips),
+        'start_lon': encode_array(start[:, 0], '<f8'),
+        'start_lat': encode_array(start[:, 1], '<f8'),
+        'end_lon': encode_array(end[:, 0], '<f8'),
+        'end_lat': encode_array(end[:, 1], '<f8'),
+        'distance': encode_array([trip.get('data.distance_meters') for trip in trips], '<f8'),
+        'user_id': encode_categories([trip.get('user_id') for trip in trips]),
+        'modes': {},
+    }
+
+    known_modes = {mlo['value'] for mlo in label_options.get('MODE', [])}
+    def get_mode(trip, mode_key):
+        if mode_key != 'mode_confirm' or mode_key not in trip:
+            return trip.get(mode_key)
+        if not trip[mode_key]:
+            return 'unlabeled'
+        if bin_other_labels and trip[mode_key] not in known_modes:
+            return 'other'
+        return trip[mode_key]
+
+    for mode_key in MODE_KEYS:
+        if not any(mode_key in trip for trip in trips):
+            continue
+        encoded = encode_categories([get_mode(trip, mode_key) for trip in trips], '<i2')
+        rich_modes = [emcdb.get_rich_mode_for_value(mode, label_options) for mode in encoded['values']]
+        modes_colors = {mode: rich_mode['color'] for mode, rich_mode in zip(encoded['values'], rich_modes)}
         deduped_colors = emcdb.dedupe_colors(modes_colors.items(), adjustment_range=[0.5, 1.5])
-        for trip in trips:
-            if mode_key in trip and trip[mode_key] in deduped_colors:
-                trip[f'{mode_key}_color'] = deduped_colors[trip[mode_key]]
+        encoded['colors'] = [deduped_colors[mode] for mode in encoded['values']]
+        encoded['icons'] = [rich_mode['icon'] for rich_mode in rich_modes]
+        map_trips['modes'][mode_key] = encoded
 
-    return trips
+    # Build the spatial index and assign the endpoints to their cluster
+    # cells now, so that the first render and every pan/zoom afterwards
+    # only need to look them up
+    (lon, lat) = get_endpoint_arrays(map_trips)
+    index_key = coordinates_key(lon, lat)
+    get_grid_index(index_key, lambda: (lon, lat))
+    get_point_clusters(index_key, lambda: (lon, lat))
+
+    return map_trips, index_key
+
+
+@callback(
+    Output('store-map-viewport', 'data'),
+    Input('trip-map-graph', 'relayoutData'),
+    State('store-map-index', 'data'),
+    prevent_initial_call=True,
+)
+def store_map_viewport(relayout_data, index_key):
+    bounds = viewport_from_relayout(relayout_data)
+    if bounds is None:
+        return no_update
+    # remember which trips the bounds were reported for, so that a stale
+    # viewport is not applied to a new set of trips
+    return {'index_key': index_key, 'bounds': bounds, 'zoom': relayout_data.get('mapbox.zoom')}
 
 
 @callback(
-    Output('trip-map-row', 'children'),
+    Output('trip-map-graph', 'figure'),
+    Output('trip-map-graph', 'style'),
+    Output('trip-map-message', 'children'),
     Input('store-map-trips', 'data'),
     Input('map-type-dropdown', 'value'),
+    Input('store-map-viewport', 'data'),
     Input({'type': 'map-filter-dropdown', 'id': ALL}, 'value'),
     Input({'type': 'map-filter-dropdown', 'id': ALL}, 'id'),
+    State('store-map-index', 'data'),
 )
-def update_output(trips, map_type, filter_values, filter_ids):
+def update_output(map_trips, map_type, viewport, filter_values, filter_ids, index_key):
     logging.info("=== Entered update_output callback ===")
     logging.info(f"map_type: {map_type}")
     logging.info(f"filter_values: {filter_values}, filter_ids: {filter_ids}")
@@ -406,21 +711,49 @@ def update_output(trips, map_type, filter_values, filter_ids):
 
     logging.info(f"selected_labeled_modes={selected_labeled_modes} | selected_ble_modes={selected_ble_modes} | selected_sensed_modes={selected_sensed_modes} | selected_uuids={selected_uuids}")
 
-    if selected_labeled_modes:
-        trips = filter_trips(trips, selected_labeled_modes, 'mode_confirm')
-    if selected_sensed_modes:
-        trips = filter_trips(trips, selected_sensed_modes, 'data.primary_sensed_mode')
-    if selected_ble_modes:
-        trips = filter_trips(trips, selected_ble_modes, 'data.primary_ble_sensed_mode')
-    if selected_uuids:
-        trips = filter_trips(trips, selected_uuids, 'user_id')
+    if not map_trips:
+        return go.Figure(), {'display': 'none'}, None
+    positions = filter_trip_positions(map_trips, filter_dict)
 
-    filter_message = dbc.Alert(f'Showing {len(trips)} trips', color="light")
-    if not trips:
+    filter_message = dbc.Alert(f'Showing {len(positions)} trips', color="light")
+    if len(positions) == 0:
         logging.info("No trips in filtered data, returning with message")
-        return filter_message
-    
-    coordinates = get_map_coordinates(trips, map_type)
+        return go.Figure(), {'display': 'none'}, filter_message
+
+    # Only draw the trips in the visible area (plus a sampled overview);
+    # the viewport is ignored until the user has moved the current map
+    (bounds, zoom) = (None, None)
+    if viewport and viewport.get('index_key') == index_key:
+        (bounds, zoom) = (viewport['bounds'], viewport.get('zoom'))
+
+    if map_type == 'flows':
+        (fig, n_flows, n_local) = create_flows_fig(map_trips, positions, index_key, zoom)
+        fig.update_layout(uirevision=index_key)
+        filter_message = dbc.Alert(
+            f'Showing {len(positions)} trips as the {n_flows} largest flows between areas '
+            f'({n_local} trips start and end in the same area)',
+            color="light",
+        )
+        return fig, {'display': 'block'}, filter_message
+
+    # Below CLUSTER_MAX_ZOOM the bubble map shows clusters instead of points
+    if map_type == 'bubble':
+        fig = create_cluster_bubble_fig(map_trips, positions, index_key, bounds, zoom)
+        if fig is not None:
+            logging.info("Drawing clustered bubble map")
+            fig.update_layout(uirevision=index_key)
+            return fig, {'display': 'block'}, filter_message
+
+    index = get_grid_index(index_key, lambda: get_endpoint_arrays(map_trips))
+    max_visible = MAX_VISIBLE_TRIP_LINES if map_type == 'lines' else MAX_VISIBLE_TRIPS
+    drawn_positions = select_trips_in_viewport(positions, index, bounds, max_visible)
+    if len(drawn_positions) < len(positions):
+        filter_message = dbc.Alert(
+            f'Showing {len(positions)} trips ({len(drawn_positions)} drawn for the current view)',
+            color="light",
+        )
+
+    coordinates = get_map_coordinates(map_trips, drawn_positions, map_type)
     # Build the figure based on map_type
     if map_type == 'lines':
         logging.info("Drawing lines map")
@@ -434,12 +767,11 @@ def update_output(trips, map_type, filter_values, filter_ids):
     else:
         logging.info("No known map_type specified; creating empty figure")
         fig = go.Figure()
+    # keep the user's camera while they pan and zoom over the same trips
+    fig.update_layout(uirevision=index_key)
     logging.info("=== update_output callback complete ===\n")
 
-    return html.Div([
-        dcc.Graph(figure=fig),
-        filter_message,
-    ])
+    return fig, {'display': 'block'}, filter_message
 
 
 @callback(
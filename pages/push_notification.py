@@ -10,9 +10,9 @@ from dash import dcc, html, Input, Output, State, callback, register_page
 import pandas as pd
 
 import emission.storage.decorations.user_queries as esdu
-import emission.core.wrapper.user as ecwu
-import emission.net.ext_service.push.notify_usage as pnu
+from utils import db_utils
 from utils.permissions import has_permission
+from utils.push_utils import send_in_batches
 
 
 if has_permission('push_send'):
@@ -154,6 +154,16 @@ def clear_push_message(n_clicks):
     return ''
 
 
+def format_batch_log(result):
+    batch = f"Batch {result['batch']}/{result['batches']} ({result['size']} users)"
+    if result['error'] is not None:
+        return f"{batch}: failed after {result['attempts']} attempts: {result['error']}"
+    retried = f" after {result['attempts']} attempts" if result['attempts'] > 1 else ""
+    return f"{batch}: sent{retried}"
+
+
+# Notifications are sent by a background callback, in concurrent batches
+# (see utils/push_utils.py), and the log is updated as each batch completes
 @callback(
     Output('push-log', 'value'),
     Output('push-send-button', 'n_clicks'),
@@ -165,15 +175,24 @@ def clear_push_message(n_clicks):
     State('push-log-options', 'value'),
     State('push-title', 'value'),
     State('push-message', 'value'),
-    State('push-survey-spec', 'value',)
+    State('push-survey-spec', 'value',),
+    background=True,
+    progress=Output('push-log', 'value'),
+    running=[(Output('push-send-button', 'disabled'), True, False)],
+    prevent_initial_call=True,
 )
-def send_push_notification( send_n_clicks, log, query_spec, emails, uuids, log_options, title, message, survey_spec):
+def send_push_notification(set_progress, send_n_clicks, log, query_spec, emails, uuids, log_options, title, message, survey_spec):
     if send_n_clicks > 0:
         logs = [f'Push Title: {title}', f'Push Message: {message}', f'Survey Spec: {survey_spec}']
         if query_spec == 'all':
             uuid_list = esdu.get_all_uuids()
         elif query_spec == 'email':
-            uuid_list = [ecwu.User.fromEmail(email).uuid for email in emails]
+            emails = emails or []
+            uuids_by_email = db_utils.query_uuids_by_email(emails)
+            unknown_emails = [email for email in emails if email not in uuids_by_email]
+            if unknown_emails:
+                logs.append(f"No user found for emails {unknown_emails}")
+            uuid_list = [uuids_by_email[email] for email in emails if email in uuids_by_email]
         elif query_spec == 'uuid':
             uuid_list = [UUID(uuid_str) for uuid_str in uuids]
         else:
@@ -183,20 +202,24 @@ def send_push_notification( send_n_clicks, log, query_spec, emails, uuids, log_o
             uuid_str_list = [str(uuid_val) for uuid_val in uuid_list]
             logs.append(f"About to send push to uuid list = {uuid_str_list}")
         if 'show-emails' in log_options:
-            email_list = [ecwu.User.fromUUID(uuid_val)._User__email for uuid_val in uuid_list if uuid_val is not None]
+            emails_by_uuid = db_utils.query_emails_by_uuid(uuid_list)
+            email_list = [emails_by_uuid.get(uuid_val) for uuid_val in uuid_list if uuid_val is not None]
             logs.append(f"About to send push to email list = {email_list}")
 
         if 'dry-run' in log_options:
             logs.append("dry run, skipping actual push")
             return "\n".join(logs), 0
         else:
-            response = pnu.send_visible_notification_to_users(
-                uuid_list,
-                title,
-                message,
-                survey_spec,
-            )
-            pnu.display_response(response)
-            logs.append("Push notification sent successfully")
+            set_progress("\n".join(logs))
+            failed = 0
+            for result in send_in_batches(uuid_list, title, message, survey_spec):
+                logs.append(format_batch_log(result))
+                if result['error'] is not None:
+                    failed += result['size']
+                set_progress("\n".join(logs))
+            if failed:
+                logs.append(f"Push notification could not be sent to {failed} of {len(uuid_list)} users")
+            else:
+                logs.append("Push notification sent successfully")
             return "\n".join(logs), 0
     return log, 0
@@ -7,26 +7,28 @@ import logging
 import json
 
 from utils.permissions import has_permission, permissions
-from utils import db_utils
+from utils import db_utils, stats_utils
 
 register_page(__name__, path="/segment_trip_time")
 
 intro = """
 ## Segment average trip time
-This page displays some statistics on average trip duration between two selected zones.
+This page displays some statistics on average trip duration between two selected zones, or along a corridor of several zones.
 
 ### Usage
 Using the polygon or square tools on the maps' menu, draw the start (left map) and end (right map) zones to consider.
 
 Data will then be fetched for trips crossing the start zone and then the end zone.
 
+To follow a corridor, draw several zones: trips must then cross every zone in order, starting with the zones of the left map in the order they were drawn, followed by those of the right map. The duration of each leg between consecutive zones is reported along with the total duration.
+
 Here are some tips on how to draw zones:
 * Zones shouldn't cover more than one parallel road; otherwise, it is unclear which path the user took.
 * A bigger zone will give more results, at the cost of lower accuracy in trip durations (the start point could be anywhere in the zone).
 * For exhaustivity, zone length should somewhat match the distance a vehicle can cross at the maximum allowed speed in 30 seconds (sample rate).
 * A smaller zone will give more accurate time results, but the number of trips might be too low to be significant.
 * Zones can be moved and edited using the Edit layer menu, and they can be deleted with the Delete layer button.
-* Please be advised that only the last added zone will be considered on each map. It is thus advised to delete existing zones before creating new ones.
+* Please be advised that every zone drawn is part of the corridor. It is thus advised to delete existing zones before creating new ones, unless adding a waypoint.
 """
 
 
@@ -88,6 +90,9 @@ layout = html.Div(
                 ),
             ]
         ),
+        dbc.Row(
+            html.Div(id='stt-progress', style={'display': 'none'}),
+        ),
         dbc.Row(
             html.Div(id='message'),
         ),
@@ -114,44 +119,116 @@ def map_end_draw(geojson):
 
 
 
-def format_duration_df(df, time_column_name='Time sample'):
-    df['Median time (minutes)'] = df.duration / 60  # convert seconds in minutes
-    df = df.reset_index().rename(
+def format_duration_df(df):
+    """
+    Format a slice of the segment duration cube (see utils/stats_utils.py)
+    for display, the durations being in seconds
+    """
+    df = df.rename(
         columns={
-            'start_fmt_time': time_column_name,
-            'duration': 'Median time (seconds)',
-            'section': 'Count',
             'mode': 'Mode',
+            'hour': 'Hour',
+            'month': 'Month',
+            'median': 'Median time (seconds)',
+            'p10': 'P10 time (seconds)',
+            'p90': 'P90 time (seconds)',
+            'iqr': 'IQR (seconds)',
+            'count': 'Count',
         }
     )
-    if time_column_name in df:
-        if 'Mode' in df:
-            df = df[
-                [
-                    'Mode',
-                    time_column_name,
-                    'Median time (seconds)',
-                    'Median time (minutes)',
-                    'Count',
-                ]
-            ]  # reorder cols
-        else:
-            df = df[
-                [
-                    time_column_name,
-                    'Median time (seconds)',
-                    'Median time (minutes)',
-                    'Count',
-                ]
-            ]  # reorder cols
-    else:
-        df = df[
-            ['Mode', 'Median time (seconds)', 'Median time (minutes)', 'Count']
-        ]  # reorder cols
+    df['Median time (minutes)'] = df['Median time (seconds)'] / 60  # convert seconds in minutes
+    df = df[
+        [col for col in ['Mode', 'Hour', 'Month'] if col in df]
+        + [
+            'Median time (seconds)',
+            'Median time (minutes)',
+            'P10 time (seconds)',
+            'P90 time (seconds)',
+            'IQR (seconds)',
+            'Count',
+        ]
+    ]  # reorder cols
     df = df.to_dict('records')  # Format for display
     return df
 
 
+def format_leg_duration_df(df, leg_columns):
+    legs = pd.DataFrame({
+        'Leg': [f'Zone {leg} to zone {leg + 1}' for leg in range(1, len(leg_columns) + 1)],
+        'Median time (seconds)': [df[col].median() for col in leg_columns],
+    })
+    legs['Median time (minutes)'] = legs['Median time (seconds)'] / 60
+    legs['Count'] = len(df)
+    return legs.to_dict('records')
+
+
+def make_duration_table(table_id, title, data):
+    return [
+        html.Br(),
+        html.H4(title),
+        dash_table.DataTable(
+            id=table_id,
+            data=data,
+            sort_action='native',
+            sort_mode='multi',
+            export_format='csv',
+        ),
+    ]
+
+
+def make_results(df, leg_columns, tables, pending=None):
+    """
+    Return the results of the page: the summary of the segments in df, the
+    tables computed so far (lists of components, see make_duration_table) and,
+    while the analysis is running, a note of what is pending
+    """
+    median_trip_time = df['duration'].median()
+    total_nb_trips = df.shape[0]
+    results = [
+        html.Br(),
+        html.H3('Results'),
+        html.Div(
+            f'Computed median segment duration is {median_trip_time} seconds, {total_nb_trips} trips considered'
+        ),
+    ]
+    for table in tables:
+        results += table
+    if pending:
+        results += [html.Br(), dbc.Spinner(size='sm'), html.Span(f' {pending}')]
+    trips_data_columns = ['start_fmt_time', 'end_fmt_time', 'mode', 'duration'] \
+        + (leg_columns if len(leg_columns) > 1 else [])
+    return dbc.Row(
+        [
+            dbc.Col(results, xs=6),
+            dbc.Col(
+                [
+                    html.Br(),
+                    html.H3('Trips Data'),
+                    dash_table.DataTable(
+                        id='trips_data',
+                        data=df[trips_data_columns].to_dict('records'),
+                        page_size=15,
+                        sort_action='native',
+                        sort_mode='multi',
+                        export_format='csv',
+                    ),
+                ] if not pending else [],
+                xs=6,
+                style={
+                    'display': 'block'
+                    if has_permission('segment_trip_time_full_trips')
+                    else 'none'
+                },
+            ),
+        ]
+    )
+
+
+# This runs as a background callback: results are reported through
+# set_progress as soon as they are available, starting with the segment
+# count and median, so the page shows partial results while modes are
+# looked up. The global spinner would hide them, so it is disabled while the
+# callback runs.
 @callback(
     Output('message', 'children'),
     Input('link-trip-time-start', 'data'),
@@ -160,9 +237,16 @@ def format_duration_df(df, time_column_name='Time sample'):
     Input('date-picker', 'end_date'),
     Input('date-picker-timezone', 'value'),
     Input('store-excluded-uuids', 'data'),
+    background=True,
+    progress=Output('stt-progress', 'children'),
+    running=[
+        (Output('global-loading', 'display'), 'hide', 'auto'),
+        (Output('stt-progress', 'style'), {'display': 'block'}, {'display': 'none'}),
+        (Output('message', 'style'), {'display': 'none'}, {'display': 'block'}),
+    ],
     prevent_initial_call=True,
 )
-def generate_content_on_endpoints_change(link_trip_time_start_str, link_trip_time_end_str, start_date, end_date, timezone, excluded_uuids):
+def generate_content_on_endpoints_change(set_progress, link_trip_time_start_str, link_trip_time_end_str, start_date, end_date, timezone, excluded_uuids):
     link_trip_time_start = json.loads(link_trip_time_start_str)
     link_trip_time_end = json.loads(link_trip_time_end_str)
     if len(link_trip_time_end["features"]) == 0 or len(link_trip_time_start["features"]) == 0:
@@ -170,123 +254,64 @@ def generate_content_on_endpoints_change(link_trip_time_start_str, link_trip_tim
     # logging.debug("link_trip_time_start: " + str(link_trip_time_start))
     # logging.debug("link_trip_time_end: " + str(link_trip_time_end))
 
+    # Zones are crossed in drawing order, from the start map to the end map
+    zones = link_trip_time_start["features"] + link_trip_time_end["features"]
+    set_progress([html.Br(), dbc.Spinner(size='sm'), html.Span(f' Searching trips crossing the {len(zones)} zones...')])
+
     # Warning: This is a database call, looks here if there is a performance hog.
     # From initial tests, this seems to be performing well, without the need to do geoqueries in memory
-    df = db_utils.query_segments_crossing_endpoints(
-        link_trip_time_start["features"][len(link_trip_time_start["features"])-1],
-        link_trip_time_end["features"][len(link_trip_time_end["features"])-1],
+    # Each zone is queried once (and cached), whatever the number of zones
+    df = db_utils.query_segments_crossing_zones(
+        zones,
         start_date,
         end_date,
         timezone,
         excluded_uuids["data"]
     )
-    total_nb_trips = df.shape[0]
-    if total_nb_trips > 0:
-        # Warning: Another db call here.
-        # In theory, we could load all inferred_section modes in memory at start time, instead of fetching it everytime
-        # However, when testing it, the operation is quite heavy on the db and on ram.
-        # I opted for querying only sections we're interested in, every time. Page load is still decent, especially when the number of section is low.
-        mode_by_section_id = db_utils.query_inferred_sections_modes(
-            df[['section', 'user_id']].to_dict('records')
-        )
-        df['mode'] = df['section'].apply(
-            lambda section_id: mode_by_section_id[str(section_id)].name
-        )
-        median_trip_time = df['duration'].median()
-        times = pd.to_datetime(df['start_fmt_time'], errors='coerce', utc=True)
-        duration_per_hour = format_duration_df(
-            df.groupby(times.dt.hour).agg({'duration': 'median', 'section': 'count'}),
-            time_column_name='Hour',
-        )
-        duration_per_mode = format_duration_df(
-            df.groupby('mode').agg({'duration': 'median', 'section': 'count'})
-        )
-        duration_per_mode_per_hour = format_duration_df(
-            df.groupby(['mode', times.dt.hour]).agg(
-                {'duration': 'median', 'section': 'count'}
-            ),
-            time_column_name='Hour',
-        )
-        duration_per_mode_per_month = format_duration_df(
-            df.groupby(['mode', times.dt.month]).agg(
-                {'duration': 'median', 'section': 'count'}
-            ),
-            time_column_name='Month',
-        )
-        return dbc.Row(
-            [
-                dbc.Col(
-                    [
-                        html.Br(),
-                        html.H3('Results'),
-                        html.Div(
-                            f'Computed median segment duration is {median_trip_time} seconds, {total_nb_trips} trips considered'
-                        ),
-                        html.Br(),
-                        html.H4('Median segment duration by mode of transport'),
-                        dash_table.DataTable(
-                            id='duration_per_mode',
-                            data=duration_per_mode,
-                            sort_action='native',
-                            sort_mode='multi',
-                            export_format='csv',
-                        ),
-                        html.Br(),
-                        html.H4(
-                            'Median segment duration by hour of the day (UTC)'
-                        ),
-                        dash_table.DataTable(
-                            id='duration_per_hour',
-                            data=duration_per_hour,
-                            sort_action='native',
-                            sort_mode='multi',
-                            export_format='csv',
-                        ),
-                        html.Br(),
-                        html.H4(
-                            'Median segment duration by mode and hour of the day (UTC)'
-                        ),
-                        dash_table.DataTable(
-                            id='duration_per_mode_per_hour',
-                            data=duration_per_mode_per_hour,
-                            sort_action='native',
-                            sort_mode='multi',
-                            export_format='csv',
-                        ),
-                        html.Br(),
-                        html.H4('Median segment duration by mode and month'),
-                        dash_table.DataTable(
-                            id='duration_per_mode_per_month',
-                            data=duration_per_mode_per_month,
-                            sort_action='native',
-                            sort_mode='multi',
-                            export_format='csv',
-                        ),
-                    ],
-                    xs=6,
-                ),
-                dbc.Col(
-                    [
-                        html.Br(),
-                        html.H3('Trips Data'),
-                        dash_table.DataTable(
-                            id='trips_data',
-                            data=df[
-                                ['start_fmt_time', 'end_fmt_time', 'mode', 'duration']
-                            ].to_dict('records'),
-                            page_size=15,
-                            sort_action='native',
-                            sort_mode='multi',
-                            export_format='csv',
-                        ),
-                    ],
-                    xs=6,
-                    style={
-                        'display': 'block'
-                        if has_permission('segment_trip_time_full_trips')
-                        else 'none'
-                    },
-                ),
-            ]
-        )
-    return [html.H3('Results'), dcc.Markdown(not_enough_data_message)]
+    if df.shape[0] == 0:
+        return [html.H3('Results'), dcc.Markdown(not_enough_data_message)]
+
+    # The tables that do not depend on modes are shown while modes are looked up
+    leg_columns = [f'leg_{leg}_duration' for leg in range(1, len(zones))]
+    duration_per_leg = make_duration_table('duration_per_leg', 'Median segment duration by leg',
+                                           format_leg_duration_df(df, leg_columns)) \
+        if len(leg_columns) > 1 else []
+    (hour, month) = stats_utils.ts_hour_month(df['start_ts'])
+    hour_cube = stats_utils.stats_cube(df['duration'], {'hour': hour})
+    duration_per_hour = make_duration_table('duration_per_hour', 'Median segment duration by hour of the day (UTC)',
+                                            format_duration_df(stats_utils.cube_slice(hour_cube, ('hour',))))
+    set_progress(make_results(df, leg_columns, [duration_per_leg, duration_per_hour],
+                              pending='Looking up modes of transport...'))
+
+    # Warning: Another db call here.
+    # In theory, we could load all inferred_section modes in memory at start time, instead of fetching it everytime
+    # However, when testing it, the operation is quite heavy on the db and on ram.
+    # Only the sections we're interested in are queried, and their modes are cached, so repeated
+    # analyses only query the sections they have not seen yet.
+    mode_by_section_id = db_utils.query_inferred_sections_modes(
+        df[['section', 'user_id']].to_dict('records')
+    )
+    df['mode'] = df['section'].apply(
+        lambda section_id: mode_by_section_id[str(section_id)].name
+    )
+    # All the tables are slices of a single mode x hour x month cube
+    cube = stats_utils.stats_cube(df['duration'], {'mode': df['mode'], 'hour': hour, 'month': month})
+    duration_per_mode = make_duration_table('duration_per_mode', 'Median segment duration by mode of transport',
+                                            format_duration_df(stats_utils.cube_slice(cube, ('mode',))))
+    duration_per_hour = make_duration_table('duration_per_hour', 'Median segment duration by hour of the day (UTC)',
+                                            format_duration_df(stats_utils.cube_slice(cube, ('hour',))))
+    duration_per_mode_per_hour = make_duration_table(
+        'duration_per_mode_per_hour', 'Median segment duration by mode and hour of the day (UTC)',
+        format_duration_df(stats_utils.cube_slice(cube, ('mode', 'hour'))),
+    )
+    duration_per_mode_per_month = make_duration_table(
+        'duration_per_mode_per_month', 'Median segment duration by mode and month',
+        format_duration_df(stats_utils.cube_slice(cube, ('mode', 'month'))),
+    )
+    return make_results(df, leg_columns, [
+        duration_per_leg,
+        duration_per_mode,
+        duration_per_hour,
+        duration_per_mode_per_hour,
+        duration_per_mode_per_month,
+    ])
@@ -3,14 +3,19 @@ import pandas as pd
 import logging
 
 import dash_bootstrap_components as dbc
-from dash import dcc, html, Input, Output, callback, State, register_page, no_update
+from dash import dcc, html, Input, Output, callback, State, register_page, no_update, \
+    clientside_callback, get_relative_path
+from dash.exceptions import PreventUpdate
 import dash_ag_grid as dag
 
-import emission.storage.decorations.token_queries as esdt
 import emcommon.auth.opcode as emcao
 
-from utils.generate_qr_codes import make_qrcode_base64_img, make_qrcodes_zipfile
+from utils.generate_qr_codes import make_qrcode_base64_img
 from utils.permissions import has_permission, config, get_token_prefix
+from utils.grid_utils import register_frame, update_frame, get_frame, get_rows_block, GRID_BLOCK_SIZE, \
+    GRID_FRAME_EXPIRED_MESSAGE
+from utils.token_utils import generate_unique_tokens, get_all_tokens, get_tokens_version
+from utils.export_utils import get_export_href
 
 
 STUDY_CONFIG = os.getenv('STUDY_CONFIG')
@@ -20,22 +25,42 @@ if has_permission('token_generate'):
 
 token_prefix = get_token_prefix()
 configured_subgroups = config.get('opcode', {}).get('subgroups')
+TOKENS_CSV_FILENAME = 'tokens-table.csv'
+TOKENS_QRCODES_FILENAME = 'tokens.zip'
+TOKENS_SHEET_FILENAME = 'tokens.pdf'
+# Height in pixels of the rows of the tokens table showing a QR code
+QR_CODE_ROW_HEIGHT = 280
 
 layout = html.Div(
     [
-        dcc.Store(id="store-tokens", data=[]),
+        dcc.Store(id="store-tokens-version"),
         dcc.Store(id="store-qrcodes", data={}),
+        dcc.Store(id="tokens-table-refreshed"),
+        dcc.Store(id="store-new-tokens"),
+        dcc.Store(id="tokens-table-appended"),
         html.Div([
             dcc.Markdown('## Tokens', style={'margin-right': 'auto'}),
             dbc.Button(children='Generate more tokens', id='open-modal-btn', n_clicks=0),
-            dbc.Button(children='Export QR codes',
-                       color='primary',
-                       outline=True,
-                       id='token-export', n_clicks=0),
-            dcc.Download(id='download-tokens'),
+            html.A(
+                dbc.Button(children='Export QR codes',
+                           color='primary',
+                           outline=True,
+                           id='token-export'),
+                id='token-export-link',
+                download=TOKENS_QRCODES_FILENAME,
+            ),
+            html.A(
+                dbc.Button(children='Print QR codes',
+                           color='primary',
+                           outline=True,
+                           id='token-print'),
+                id='token-print-link',
+                download=TOKENS_SHEET_FILENAME,
+            ),
         ],
             style={'display': 'flex', 'gap': '5px', 'margin-bottom': '20px'}
         ),
+        dbc.Progress(id='generate-tokens-progress', value=0, style={'display': 'none'}),
         html.Div(id='token-table'),
         dbc.Modal([
             dbc.ModalHeader("Generate tokens"),
@@ -84,12 +109,14 @@ layout = html.Div(
 )
 
 
+# The tokens are cached by the server (see utils/token_utils.py); the page
+# only holds their version, to make the table again when it changes
 @callback(
-    Output('store-tokens', 'data'),
-    Input('store-tokens', 'data'),
+    Output('store-tokens-version', 'data'),
+    Input('store-tokens-version', 'data'),
 )
 def load_tokens(_):
-    return esdt.get_all_tokens()
+    return get_tokens_version()
 
 
 @callback(
@@ -140,88 +167,161 @@ def validate_token_inputs(program, subgroup, token_length, token_count):
     return False, info, 'info'
 
 
+# Tokens are generated by a background callback, a chunk at a time (see
+# utils/token_utils.py). Each chunk is reported as progress, to be appended
+# to the table; progress is polled, so a chunk can be skipped, but the table
+# is made again from all the tokens once they are generated.
 @callback(
-    Output('store-tokens', 'data', allow_duplicate=True),
-    Output('generate-tokens-btn', 'n_clicks'),
+    Output('store-tokens-version', 'data', allow_duplicate=True),
     Input('generate-tokens-btn', 'n_clicks'),
-    Input('token-program', 'value'),
-    Input('token-subgroup', 'value'),
-    Input('token-length', 'value'),
-    Input('token-count', 'value'),
-    State('store-tokens', 'data'),
-    Input('store-uuids', 'data'),
+    State('token-program', 'value'),
+    State('token-subgroup', 'value'),
+    State('token-length', 'value'),
+    State('token-count', 'value'),
+    background=True,
+    progress=[
+        Output('generate-tokens-progress', 'value'),
+        Output('generate-tokens-progress', 'label'),
+        Output('store-new-tokens', 'data'),
+    ],
+    running=[
+        (Output('generate-tokens-btn', 'disabled'), True, False),
+        (Output('generate-tokens-progress', 'style'), {'margin-bottom': '20px'}, {'display': 'none'}),
+    ],
     prevent_initial_call=True
 )
-def generate_tokens(n_clicks, program, subgroup, token_length, token_count, tokens, uuids):
-    if n_clicks is not None and n_clicks > 0:
-        new_tokens = [
-            emcao.generate_opcode(token_prefix, program, subgroup, token_length)
-            for _ in range(token_count)
-        ]
-        esdt.insert_many_tokens(new_tokens)
-        tokens += new_tokens
-        return tokens, 0
-    return no_update, no_update
+def generate_tokens(set_progress, n_clicks, program, subgroup, token_length, token_count):
+    if not n_clicks:
+        return no_update
+    set_progress((0, f'0 / {token_count} tokens', []))
+    generated = 0
+    for inserted in generate_unique_tokens(token_count, token_prefix, program, subgroup, token_length):
+        generated += len(inserted)
+        set_progress((100 * generated / token_count, f'{generated} / {token_count} tokens', inserted))
+    return get_tokens_version()
 
 
 @callback(
-    Output('download-tokens', 'data'),
-    Input('token-export', 'n_clicks'),
-    State('store-tokens', 'data'),
+    Output('tokens-table-appended', 'data'),
+    Input('store-new-tokens', 'data'),
+    State('tokens-table-frame', 'data'),
     prevent_initial_call=True,
 )
-def export_tokens(_, tokens):
-    zip_fn = make_qrcodes_zipfile(tokens)
-    return dcc.send_bytes(zip_fn, "tokens.zip")
+def append_new_tokens(new_tokens, frame_key):
+    df = get_frame(frame_key)
+    if df is None or not new_tokens:
+        raise PreventUpdate
+    new_df = pd.DataFrame({'token': new_tokens, 'in_use': False})
+    update_frame(frame_key, pd.concat([df, new_df], ignore_index=True))
+    return len(df) + len(new_df)
 
 
 @callback(
     Output('token-table', 'children'),
     Input('store-uuids', 'data'),
-    Input('store-tokens', 'data'),
-    Input('store-qrcodes', 'data'),
+    Input('store-tokens-version', 'data'),
 )
-def populate_datatable(uuids, tokens, qrcodes):
-    logging.info(f'tokens: {tokens}')
+def populate_datatable(uuids, _tokens_version):
+    tokens = get_all_tokens()
     if not tokens:
         return None
+    logging.debug(f'Populating the tokens table with {len(tokens)} tokens')
     df = pd.DataFrame({'token': tokens})
-    df['qr_code'] = df['token'].map(qrcodes).fillna('(click to reveal)')
-    uuids_records = uuids.get('data', [])
-    df['in_use'] = df.apply(
-        lambda row: any(uuid['user_email'] == row['token']
-                        for uuid in uuids_records),
-        axis=1,
-    )
-    df = df.reindex(columns=['token', 'in_use', 'qr_code'])
+    emails_in_use = {uuid['user_email'] for uuid in uuids.get('data', [])}
+    df['in_use'] = df['token'].isin(emails_in_use)
+    # The grid fetches rows block by block from the frame kept on the server
+    # (see serve_tokens_rows), so programs with many tokens only send the
+    # visible ones
+    frame_key = register_frame(df)
     return html.Div([
+        dbc.Alert(GRID_FRAME_EXPIRED_MESSAGE, id='tokens-table-expired', color='warning', is_open=False),
         dag.AgGrid(
             id='tokens-table',
-            rowData=df.to_dict('records'),
-            columnDefs=[{"field": c, "headerName": c,
-                         "minWidth": 500 if c == 'qr_code' else 0} for c in df.columns],
+            rowModelType="infinite",
+            columnDefs=[{"field": c, "headerName": c} for c in df.columns]
+                + [{"field": 'qr_code', "headerName": 'qr_code', "minWidth": 500,
+                    "sortable": False, "filter": False}],
             defaultColDef={"sortable": True, "filter": True,
-                          "cellRenderer": "markdown",
-                          "autoHeight": True},
-            dashGridOptions={"pagination": True, "enableCellTextSelection": True},
+                          "cellRenderer": "markdown"},
+            dashGridOptions={
+                "pagination": True,
+                "cacheBlockSize": GRID_BLOCK_SIZE,
+                "enableCellTextSelection": True,
+                # autoHeight is not supported by the infinite row model, so
+                # rows showing a QR code are given its height
+                "getRowHeight": {"function": f"params.data && params.data.qr_code.startsWith('!') ? {QR_CODE_ROW_HEIGHT} : undefined"},
+            },
             columnSize="autoSize",
             style={"height": "700px",
                    "--ag-font-family": "monospace"},
             getRowId="params.data.token",
         ),
-        dbc.Button("Download CSV", id="export-tokens-table-btn",
-                   color="primary", outline=True, className="mt-3"),
+        dcc.Store(id='tokens-table-frame', data=frame_key),
+        html.A(
+            dbc.Button("Download CSV", color="primary", outline=True, className="mt-3"),
+            id="export-tokens-table-link",
+            href=get_relative_path(get_export_href(frame_key, TOKENS_CSV_FILENAME)),
+            download=TOKENS_CSV_FILENAME,
+        ),
     ])
 
 
 @callback(
-    Output("tokens-table", "exportDataAsCsv"),
-    Output("tokens-table", "csvExportParams"),
-    Input("export-tokens-table-btn", "n_clicks"),
+    Output('tokens-table', 'getRowsResponse'),
+    Output('tokens-table-expired', 'is_open'),
+    Input('tokens-table', 'getRowsRequest'),
+    State('tokens-table-frame', 'data'),
+    State('store-qrcodes', 'data'),
+)
+def serve_tokens_rows(request, frame_key, qrcodes):
+    if not request:
+        raise PreventUpdate
+    response = get_rows_block(frame_key, request)
+    if response is None:
+        return {'rowData': [], 'rowCount': 0}, True
+    # QR codes are only made for the tokens that were clicked, so they are
+    # merged into each block of rows rather than kept in the frame
+    for row in response['rowData']:
+        row['qr_code'] = qrcodes.get(row['token'], '(click to reveal)')
+    return response, False
+
+
+# Blocks already fetched by the grid are refetched to show new QR codes and
+# new tokens
+clientside_callback(
+    """
+    function(qrcodes, nTokens) {
+        try {
+            dash_ag_grid.getApi('tokens-table').refreshInfiniteCache();
+        } catch (e) {
+            // the table is not displayed
+        }
+        return [Object.keys(qrcodes || {}).length, nTokens];
+    }
+    """,
+    Output('tokens-table-refreshed', 'data'),
+    Input('store-qrcodes', 'data'),
+    Input('tokens-table-appended', 'data'),
     prevent_initial_call=True,
 )
-def export_table_as_csv(_):
-    return True, {"fileName": "tokens-table.csv"}
+
+
+# The QR codes are rendered by the server as they are downloaded, zipped or
+# laid out on printable sheets (see utils/export_utils.py), for the tokens
+# shown by the table
+@callback(
+    Output('export-tokens-table-link', 'href'),
+    Output('token-export-link', 'href'),
+    Output('token-print-link', 'href'),
+    Input('tokens-table', 'filterModel'),
+    Input('tokens-table-frame', 'data'),
+)
+def update_export_links(filter_model, frame_key):
+    return (
+        get_relative_path(get_export_href(frame_key, TOKENS_CSV_FILENAME, filter_model)),
+        get_relative_path(get_export_href(frame_key, TOKENS_QRCODES_FILENAME, filter_model, qrcodes=True)),
+        get_relative_path(get_export_href(frame_key, TOKENS_SHEET_FILENAME, filter_model, qrcodes=True)),
+    )
 
 
 @callback(
@@ -0,0 +1,133 @@
+# cache_utils.py
+import json
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import diskcache
+
+# Directory of the caches shared by the processes of the dashboard: the
+# server workers and the processes running background callbacks
+CACHE_DIR = os.getenv('DASH_CACHE_DIR', './cache')
+
+
+class LRUCache:
+    """
+    A small thread-safe least-recently-used cache.
+    Entries live in the memory of the current server process, so callbacks
+    that use it must be able to rebuild a missing entry on demand.
+    If maxbytes is given, entries are also evicted while the total of their
+    sizeof(value) exceeds it; the most recent entry is always kept.
+    """
+
+    def __init__(self, maxsize=16, maxbytes=None, sizeof=None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self._sizeof = sizeof
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def set(self, key, value):
+        size = self._sizeof(value) if self.maxbytes is not None else 0
+        with self._lock:
+            self._nbytes += size - self._sizes.get(key, 0)
+            self._entries[key] = value
+            self._sizes[key] = size
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize or \
+                    (self.maxbytes is not None and self._nbytes > self.maxbytes and len(self._entries) > 1):
+                (evicted, _) = self._entries.popitem(last=False)
+                self._nbytes -= self._sizes.pop(evicted)
+        return value
+
+    def get_or_create(self, key, factory):
+        """
+        Return the entry for key, calling factory() to create it if missing.
+        factory is called outside the lock so that slow builds do not block
+        readers of other keys.
+        """
+        value = self.get(key)
+        if value is None:
+            value = self.set(key, factory())
+        return value
+
+    def pop(self, key, default=None):
+        with self._lock:
+            self._nbytes -= self._sizes.pop(key, 0)
+            return self._entries.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+            self._nbytes = 0
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+
+class SqliteStore:
+    """
+    A persistent key-value store of JSON values in a SQLite file.
+    A connection is opened per operation, so the store can be shared by
+    threads and processes.
+    """
+
+    # SQLite limits the number of parameters of a statement
+    BATCH_SIZE = 500
+
+    def __init__(self, path, table='entries'):
+        self.path = path
+        self.table = table
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with self._connect() as connection:
+            connection.execute(f'CREATE TABLE IF NOT EXISTS {self.table} (key TEXT PRIMARY KEY, value TEXT)')
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get_many(self, keys):
+        """
+        Return a dict of the values of the keys that are in the store
+        """
+        keys = list(keys)
+        found = {}
+        with self._connect() as connection:
+            for start in range(0, len(keys), self.BATCH_SIZE):
+                batch = keys[start:start + self.BATCH_SIZE]
+                placeholders = ','.join('?' * len(batch))
+                rows = connection.execute(
+                    f'SELECT key, value FROM {self.table} WHERE key IN ({placeholders})', batch
+                )
+                found.update((key, json.loads(value)) for (key, value) in rows)
+        return found
+
+    def set_many(self, items):
+        with self._connect() as connection:
+            connection.executemany(
+                f'INSERT OR REPLACE INTO {self.table} (key, value) VALUES (?, ?)',
+                [(key, json.dumps(value)) for (key, value) in dict(items).items()],
+            )
+
+
+def get_disk_cache(name):
+    """
+    Return the diskcache.Cache called name in CACHE_DIR. Values are pickled,
+    and the cache can be used concurrently by several processes.
+    """
+    return diskcache.Cache(os.path.join(CACHE_DIR, name))
@@ -0,0 +1,53 @@
+# columnar_utils.py
+import base64
+
+import numpy as np
+
+
+def encode_array(values, dtype):
+    """
+    Encode a 1D array as base64 of its raw bytes, so that it can be kept in a
+    dcc.Store at a fraction of the size of a JSON list of numbers
+    """
+    array = np.ascontiguousarray(values, dtype=dtype)
+    return {
+        'dtype': array.dtype.str,
+        'data': base64.b64encode(array.tobytes()).decode('ascii'),
+    }
+
+
+def decode_array(encoded):
+    """
+    Decode an array encoded with encode_array
+    """
+    return np.frombuffer(base64.b64decode(encoded['data']), dtype=np.dtype(encoded['dtype']))
+
+
+def encode_categories(values, dtype='<i4'):
+    """
+    Dictionary-encode a sequence of values: returns the sorted unique values
+    and an encoded array of codes into them, with -1 for missing values
+    """
+    present = sorted({v for v in values if v is not None})
+    codes_by_value = {v: i for i, v in enumerate(present)}
+    codes = [codes_by_value[v] if v is not None else -1 for v in values]
+    return {
+        'values': present,
+        'codes': encode_array(codes, dtype),
+    }
+
+
+def decode_categories(encoded):
+    """
+    Return the (values, codes) of categories encoded with encode_categories
+    """
+    return encoded['values'], decode_array(encoded['codes'])
+
+
+def category_mask(encoded, selected_values):
+    """
+    Return a boolean mask of the entries whose value is in selected_values
+    """
+    (values, codes) = decode_categories(encoded)
+    selected_codes = [i for i, v in enumerate(values) if v in selected_values]
+    return np.isin(codes, selected_codes)
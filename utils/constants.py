@@ -42,6 +42,7 @@ VALID_UUIDS_COLS = [
     'create_ts',
     'total_trips',
     'labeled_trips',
+    'last_trip_ts',
     'pipeline_range.start_ts',
     'pipeline_range.end_ts',
     'last_call_ts',
@@ -37,3 +37,18 @@ def ts_to_iso(ts: float):
     if pd.isna(ts):
         return None
     return arrow.get(ts).format('YYYY-MM-DD HH:mm:ss')
+
+
+def ts_series_to_iso(ts: pd.Series):
+    """
+    Vectorized ts_to_iso: formats a series of epoch timestamps, or of dates
+    (ISO strings or datetimes, UTC unless they have a timezone), as
+    'YYYY-MM-DD HH:mm:ss' (UTC), with None for missing timestamps
+    """
+    numeric = pd.to_numeric(ts, errors='coerce')
+    dates = pd.to_datetime(numeric, unit='s', utc=True)
+    not_numeric = numeric.isna() & ts.notna()
+    if not_numeric.any():
+        dates[not_numeric] = pd.to_datetime(ts[not_numeric], utc=True, errors='coerce', format='ISO8601')
+    formatted = dates.dt.strftime('%Y-%m-%d %H:%M:%S')
+    return formatted.astype(object).where(formatted.notna(), None)
@@ -1,25 +1,41 @@
+import hashlib
+import json
 import logging
+import os
 import arrow
 from uuid import UUID
 
 import pandas as pd
 import pymongo
+from pymongo.errors import BulkWriteError
 
 import emission.core.get_database as edb
 import emission.storage.timeseries.abstract_timeseries as esta
-import emission.storage.timeseries.aggregate_timeseries as estag
 import emission.storage.timeseries.timequery as estt
 import emission.core.wrapper.motionactivity as ecwm
+import emission.core.wrapper.modeprediction as ecwmp
 import emission.storage.timeseries.geoquery as estg
-import emission.storage.decorations.section_queries as esds
 import emission.core.timer as ect
 import emission.storage.decorations.stats_queries as esdsq
 
 from utils import constants
 from utils import permissions as perm_utils
 from utils.datetime_utils import iso_range_to_ts_range
+from utils.survey_utils import flatten_survey_entries
+from utils.cache_utils import CACHE_DIR, LRUCache, SqliteStore, get_disk_cache
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
+# Maximum number of values of the $in queries of the users lookups
+UUID_LOOKUP_BATCH_SIZE = 10000
+
+# First location of each section in the zones of the segment trip time
+# page, keyed by zone_locations_key. The page runs its queries in background
+# callback processes, so results are kept on disk for the next query to
+# find them. New locations keep being added, so those expire.
+ZONE_LOCATIONS_CACHE_TTL = 3600
+_zone_locations_cache = get_disk_cache('zone_locations')
+
+
 def df_to_filtered_records(df, col_to_filter=None, vals_to_exclude: list[str] = []):
     """
     Returns a dictionary of df records, given a dataframe, a column to filter on,
@@ -92,6 +108,73 @@ def query_users():
     return users_df
 
 
+def query_uuids_by_email(emails):
+    """
+    Returns a dict of the uuid of each of emails that belongs to a user, with
+    a single query (per UUID_LOOKUP_BATCH_SIZE emails)
+    """
+    return {
+        entry['user_email']: entry['uuid']
+        for entry in _find_uuid_entries('user_email', emails)
+    }
+
+
+def query_emails_by_uuid(uuids):
+    """
+    Returns a dict of the email of each of uuids that belongs to a user, with
+    a single query (per UUID_LOOKUP_BATCH_SIZE uuids)
+    """
+    return {
+        entry['uuid']: entry['user_email']
+        for entry in _find_uuid_entries('uuid', uuids)
+    }
+
+
+def _find_uuid_entries(field, values):
+    values = list(values)
+    for start in range(0, len(values), UUID_LOOKUP_BATCH_SIZE):
+        yield from edb.get_uuid_db().find(
+            {field: {'$in': values[start:start + UUID_LOOKUP_BATCH_SIZE]}},
+            {'_id': 0, 'user_email': 1, 'uuid': 1},
+        )
+
+
+def query_users_stats(user_ids: list[str]):
+    """
+    Returns a DataFrame with, for each of the given users, their number of
+    confirmed trips, how many of those are labeled and when their last trip
+    ended. Users without trips get 0 trips and no last trip.
+    """
+    with ect.Timer() as stats_timer:
+        logging.debug(f"Querying trip stats of {len(user_ids)} users")
+        pipeline = [
+            {'$match': {
+                'metadata.key': 'analysis/confirmed_trip',
+                'user_id': {'$in': [UUID(user_id) for user_id in user_ids]},
+            }},
+            {'$group': {
+                '_id': '$user_id',
+                'total_trips': {'$sum': 1},
+                'labeled_trips': {'$sum': {'$cond': [
+                    {'$gt': [{'$size': {'$objectToArray': {'$ifNull': ['$data.user_input', {}]}}}, 0]}, 1, 0
+                ]}},
+                'last_trip_ts': {'$max': '$data.end_ts'},
+            }},
+        ]
+        stats = {str(entry['_id']): entry for entry in analysis_timeseries_db.aggregate(pipeline)}
+        stats_df = pd.DataFrame({
+            'user_id': user_ids,
+            'total_trips': [stats.get(user_id, {}).get('total_trips', 0) for user_id in user_ids],
+            'labeled_trips': [stats.get(user_id, {}).get('labeled_trips', 0) for user_id in user_ids],
+            'last_trip_ts': [stats.get(user_id, {}).get('last_trip_ts') for user_id in user_ids],
+        })
+    esdsq.store_dashboard_time(
+        "admin/db_utils/query_users_stats/aggregate_trips",
+        stats_timer,
+    )
+    return stats_df
+
+
 def query_confirmed_trips(start_date: str, end_date: str, tz: str):
     with ect.Timer() as total_timer:
 
@@ -128,11 +211,8 @@ def query_confirmed_trips(start_date: str, end_date: str, tz: str):
             
             # Stage 3: Rename columns
             with ect.Timer() as stage3_timer:
-                rename_cols = constants.VALID_TRIP_COLS
                 # the mapping is `{distance: data.distance, duration: data.duration} etc
-                rename_mapping = dict(zip([c.replace("data.", "") for c in rename_cols], rename_cols))
-                logging.debug("Rename mapping is %s" % rename_mapping)
-                df.rename(columns=rename_mapping, inplace=True)
+                df.rename(columns=perm_utils.column_plan.trip_rename, inplace=True)
                 logging.debug("After renaming columns, they are %s" % df.columns)
             esdsq.store_dashboard_time(
                 "admin/db_utils/query_confirmed_trips/rename_columns",
@@ -191,9 +271,9 @@ def query_confirmed_trips(start_date: str, end_date: str, tz: str):
                        "_id" not in c]
                 logging.debug(f"After filtering {user_input_cols=}")
 
-                combined_col_list = list(perm_utils.get_all_trip_columns()) + user_input_cols
-                logging.debug(f"Combined list {combined_col_list=}")
-                columns = [col for col in combined_col_list if col in df.columns]
+                combined_col_list = perm_utils.column_plan.all_trip_columns + tuple(user_input_cols)
+                present_cols = set(df.columns)
+                columns = [col for col in combined_col_list if col in present_cols]
                 df = df[columns]
                 logging.debug(f"After filtering against the combined list {df.columns=}")
             esdsq.store_dashboard_time(
@@ -207,9 +287,9 @@ def query_confirmed_trips(start_date: str, end_date: str, tz: str):
                 for col in constants.BINARY_TRIP_COLS:
                     if col in df.columns:
                         df[col] = df[col].apply(str)
-                for named_col in perm_utils.get_all_named_trip_columns():
-                    if named_col['path'] in df.columns:
-                        df[named_col['label']] = df[named_col['path']]
+                for (label, path) in perm_utils.column_plan.named_trip_columns:
+                    if path in df.columns:
+                        df[label] = df[path]
                         # df = df.drop(columns=[named_col['path']])
             esdsq.store_dashboard_time(
                 "admin/db_utils/query_confirmed_trips/process_binary_and_named_columns",
@@ -278,46 +358,17 @@ def query_demographics():
             stage2_timer
         )
 
-        # Stage 3: Create dataframes for each survey key
+        # Stage 3: Create dataframes for each survey key, with only the
+        # columns of the survey's column plan
         with ect.Timer() as stage3_timer:
             dataframes = {}
             for key, json_object in available_key.items():
-                df = pd.json_normalize(json_object)
-                dataframes[key] = df
+                dataframes[key] = flatten_survey_entries(key, json_object)
         esdsq.store_dashboard_time(
             "admin/db_utils/query_demographics/create_dataframes",
             stage3_timer
         )
 
-        # Stage 4: Process each dataframe
-        with ect.Timer() as stage4_timer:
-            for key, df in dataframes.items():
-                if not df.empty:
-                    # Convert binary demographic columns
-                    for col in constants.BINARY_DEMOGRAPHICS_COLS:
-                        if col in df.columns:
-                            df[col] = df[col].apply(str) 
-                    
-                    # Drop metadata columns
-                    columns_to_drop = [col for col in df.columns if col.startswith("metadata")]
-                    df.drop(columns=columns_to_drop, inplace=True)
-
-                    # Modify columns based on demographic settings
-                    modified_columns = perm_utils.get_demographic_columns(df.columns)  
-                    df.columns = modified_columns 
-
-                    # Simplify column names for display
-                    df.columns = [col.rsplit('.', 1)[-1] if col.startswith('data.jsonDocResponse.') else col for col in df.columns]  
-
-                    # Drop excluded demographic columns
-                    for col in constants.EXCLUDED_DEMOGRAPHICS_COLS:
-                        if col in df.columns:
-                            df.drop(columns=[col], inplace=True)
-        esdsq.store_dashboard_time(
-            "admin/db_utils/query_demographics/process_dataframes",
-            stage4_timer
-        )
-
     esdsq.store_dashboard_time(
         "admin/db_utils/query_demographics/total_time",
         total_timer
@@ -400,83 +451,273 @@ def query_trajectories(start_date: str, end_date: str, tz: str, key_list):
     return df
 
 
+def _round_coordinates(coordinates, decimals=7):
+    if isinstance(coordinates, (list, tuple)):
+        return [_round_coordinates(c, decimals) for c in coordinates]
+    return round(coordinates, decimals)
+
+
+def zone_locations_key(poly_region, start_ts, end_ts, excluded_uuids: list[str]):
+    """
+    Returns a key identifying the locations of a zone query: a hash of the
+    zone geometry (without feature properties, with coordinates rounded to
+    ~1cm), the time range and the excluded users
+    """
+    geometry = poly_region.get('geometry', poly_region)
+    normalized = {
+        'type': geometry.get('type'),
+        'coordinates': _round_coordinates(geometry.get('coordinates', [])),
+        'range': [start_ts, end_ts],
+        'excluded': sorted(excluded_uuids),
+    }
+    return hashlib.sha1(json.dumps(normalized, sort_keys=True).encode()).hexdigest()
+
+
+# Fields of the recreated locations used by the segment queries, with their
+# path in the documents and their dtype
+ZONE_LOCATION_FIELDS = {
+    'section': ('data.section', object),
+    'user_id': ('user_id', object),
+    'idx': ('data.idx', 'int64'),
+    'ts': ('data.ts', 'float64'),
+    'fmt_time': ('data.fmt_time', object),
+    'mode': ('data.mode', 'Int64'),
+}
+
+
+def zone_match_stages(poly_region, start_ts, end_ts, excluded_uuids: list[str]):
+    """
+    Returns the aggregation stages matching the locations inside poly_region,
+    projected to the fields of ZONE_LOCATION_FIELDS so that the whole
+    location documents (local_dt, heading, altitude, accuracy...) are never
+    carried through the pipeline
+    """
+    return [
+        {'$match': {
+            'metadata.key': 'analysis/recreated_location',
+            **estt.TimeQuery("data.ts", start_ts, end_ts).get_query(),
+            'user_id': {'$nin': [UUID(uuid) for uuid in excluded_uuids]},
+            **estg.GeoQuery(['data.loc'], poly_region).get_query(),
+        }},
+        {'$project': {'_id': 0, **{name: f'${path}' for (name, (path, _)) in ZONE_LOCATION_FIELDS.items()}}},
+    ]
+
+
+def zone_locations_pipeline(poly_region, start_ts, end_ts, excluded_uuids: list[str]):
+    """
+    Returns the aggregation pipeline of the first location of each section
+    inside poly_region
+    """
+    return [
+        *zone_match_stages(poly_region, start_ts, end_ts, excluded_uuids),
+        {'$sort': {'ts': 1}},
+        {'$group': {
+            '_id': '$section',
+            **{name: {'$first': f'${name}'} for name in ZONE_LOCATION_FIELDS if name != 'section'},
+        }},
+    ]
+
+
+def query_zone_first_locations(poly_region, start_ts, end_ts, excluded_uuids: list[str]):
+    """
+    Returns a DataFrame with the first recreated location (idx, ts, fmt_time,
+    mode) of each section inside poly_region, typed as in
+    ZONE_LOCATION_FIELDS. Results are cached per zone so that editing one
+    zone of a query does not query the other one again.
+    """
+    def query():
+        pipeline = zone_locations_pipeline(poly_region, start_ts, end_ts, excluded_uuids)
+        locations = list(analysis_timeseries_db.aggregate(pipeline, allowDiskUse=True))
+        return pd.DataFrame(locations, columns=['_id', *list(ZONE_LOCATION_FIELDS)[1:]]) \
+            .rename(columns={'_id': 'section'}) \
+            .astype({name: dtype for (name, (_, dtype)) in ZONE_LOCATION_FIELDS.items()})
+
+    key = zone_locations_key(poly_region, start_ts, end_ts, excluded_uuids)
+    locations = _zone_locations_cache.get(key)
+    if locations is None:
+        locations = query()
+        _zone_locations_cache.set(key, locations, expire=ZONE_LOCATIONS_CACHE_TTL)
+    return locations
+
+
+def zones_crossing_pipeline(poly_regions, start_ts, end_ts, excluded_uuids: list[str]):
+    """
+    Returns the aggregation pipeline of the sections that go through each of
+    the zones of poly_regions, in order, in a single query: the locations in
+    any zone (tagged with the zone number, through $unionWith) are grouped
+    by section, keeping the first location of each section in each zone,
+    and only the sections whose first locations are in the order of the
+    zones are returned, with the idx_<zone>, ts_<zone> and fmt_time_<zone>
+    of their first location in each zone
+    """
+    def zone_stages(zone, poly_region):
+        stages = zone_match_stages(poly_region, start_ts, end_ts, excluded_uuids)
+        stages[-1]['$project']['zone'] = {'$literal': zone}
+        return stages
+
+    def first_in_zone(zone, name):
+        # $max ignores the nulls of the other zones
+        return {'$max': {'$cond': [{'$eq': ['$_id.zone', zone]}, f'${name}', None]}}
+
+    zones = range(len(poly_regions))
+    last = len(poly_regions) - 1
+    return [
+        *zone_stages(0, poly_regions[0]),
+        *[{'$unionWith': {'coll': analysis_timeseries_db.name, 'pipeline': zone_stages(zone, poly_regions[zone])}}
+          for zone in zones if zone > 0],
+        {'$sort': {'ts': 1}},
+        {'$group': {
+            '_id': {'section': '$section', 'zone': '$zone'},
+            **{name: {'$first': f'${name}'} for name in ZONE_LOCATION_FIELDS if name != 'section'},
+        }},
+        {'$group': {
+            '_id': '$_id.section',
+            'user_id': first_in_zone(last, 'user_id'),
+            'mode': first_in_zone(0, 'mode'),
+            **{f'{name}_{zone}': first_in_zone(zone, name) for zone in zones for name in ('idx', 'ts', 'fmt_time')},
+        }},
+        {'$match': {
+            **{f'idx_{zone}': {'$ne': None} for zone in zones},
+            '$expr': {'$and': [{'$lt': [f'$idx_{zone - 1}', f'$idx_{zone}']} for zone in zones if zone > 0]},
+        }},
+    ]
+
+
+def query_zones_crossing_sections(poly_regions, start_ts, end_ts, excluded_uuids: list[str]):
+    """
+    Returns the sections that go through each of the zones of poly_regions,
+    in order, as query_segments_crossing_zones does, from a single
+    aggregation that only returns the qualifying sections
+    """
+    pipeline = zones_crossing_pipeline(poly_regions, start_ts, end_ts, excluded_uuids)
+    sections = list(analysis_timeseries_db.aggregate(pipeline, allowDiskUse=True))
+    zones = range(len(poly_regions))
+    last = len(poly_regions) - 1
+    df = pd.DataFrame(sections, columns=[
+        '_id', 'user_id', 'mode', *[f'{name}_{zone}' for zone in zones for name in ('idx', 'ts', 'fmt_time')],
+    ]).rename(columns={'_id': 'section'})
+    df = df.astype({'user_id': object, 'mode': 'Int64', **{f'ts_{zone}': 'float64' for zone in zones}})
+    crossing = pd.DataFrame({
+        'section': df['section'],
+        'user_id': df['user_id'],
+        'start_ts': df['ts_0'],
+        'start_fmt_time': df['fmt_time_0'],
+        'end_fmt_time': df[f'fmt_time_{last}'],
+        'mode': df['mode'],
+        'duration': df[f'ts_{last}'] - df['ts_0'],
+    })
+    for zone in zones:
+        if zone > 0:
+            crossing[f'leg_{zone}_duration'] = df[f'ts_{zone}'] - df[f'ts_{zone - 1}']
+    return crossing
+
+
+def _seen_zone_key(zone_key):
+    return f'seen:{zone_key}'
+
+
 def query_segments_crossing_endpoints(poly_region_start, poly_region_end, start_date: str, end_date: str, tz: str, excluded_uuids: list[str]):
+    return query_segments_crossing_zones([poly_region_start, poly_region_end], start_date, end_date, tz, excluded_uuids)
+
+
+def query_segments_crossing_zones(poly_regions, start_date: str, end_date: str, tz: str, excluded_uuids: list[str]):
+    """
+    Returns the sections that go through each of the zones of poly_regions,
+    in order, with their total duration from the first to the last zone and
+    the duration of each leg between consecutive zones (leg_1_duration,
+    leg_2_duration...)
+    """
     with ect.Timer() as total_timer:
 
-        # Stage 1: Convert date range to timestamps and set up time and exclusion queries
+        # Stage 1: Convert date range to timestamps
         with ect.Timer() as stage1_timer:
             (start_ts, end_ts) = iso_range_to_ts_range(start_date, end_date, tz)
-            tq = estt.TimeQuery("data.ts", start_ts, end_ts)
-            not_excluded_uuid_query = {'user_id': {'$nin': [UUID(uuid) for uuid in excluded_uuids]}}
-            agg_ts = estag.AggregateTimeSeries().get_aggregate_time_series()
+            zone_keys = [zone_locations_key(poly_region, start_ts, end_ts, excluded_uuids)
+                         for poly_region in poly_regions]
         esdsq.store_dashboard_time(
-            "admin/db_utils/query_segments_crossing_endpoints/convert_date_range_and_setup_queries",
+            "admin/db_utils/query_segments_crossing_zones/convert_date_range_and_setup_queries",
             stage1_timer
         )
 
-        # Stage 2: Fetch locations matching start region
+        # Stage 2: Zones that were never queried are queried together in a
+        # single aggregation, which only returns the qualifying sections, and
+        # its result is cached for these zones. Once one of the zones is
+        # queried with other zones (e.g. the other zone was edited), the
+        # first location of each section in each zone is fetched and cached
+        # per zone instead, so that editing one zone only queries that zone
+        # again.
         with ect.Timer() as stage2_timer:
-            locs_matching_start = agg_ts.get_data_df(
-                                      "analysis/recreated_location",
-                                      geo_query=estg.GeoQuery(['data.loc'], poly_region_start),
-                                      time_query=tq,
-                                      extra_query_list=[not_excluded_uuid_query]
-                                  )
-            locs_matching_start = locs_matching_start.drop_duplicates(subset=['section'])
+            crossing_key = 'crossing:' + ':'.join(zone_keys)
+            filtered = _zone_locations_cache.get(crossing_key)
+            per_zone = filtered is None and any(
+                key in _zone_locations_cache or _seen_zone_key(key) in _zone_locations_cache for key in zone_keys
+            )
+            if filtered is not None:
+                logging.debug("Reusing the sections crossing these zones")
+            elif per_zone:
+                zones_locations = [
+                    query_zone_first_locations(poly_region, start_ts, end_ts, excluded_uuids).set_index('section')
+                    for poly_region in poly_regions
+                ]
+            else:
+                filtered = query_zones_crossing_sections(poly_regions, start_ts, end_ts, excluded_uuids)
+                _zone_locations_cache.set(crossing_key, filtered, expire=ZONE_LOCATIONS_CACHE_TTL)
+                for key in zone_keys:
+                    _zone_locations_cache.set(_seen_zone_key(key), True, expire=ZONE_LOCATIONS_CACHE_TTL)
         esdsq.store_dashboard_time(
-            "admin/db_utils/query_segments_crossing_endpoints/fetch_start_locations",
+            "admin/db_utils/query_segments_crossing_zones/fetch_zone_locations",
             stage2_timer
         )
 
-        # Stage 3: Fetch locations matching end region
-        with ect.Timer() as stage3_timer:
-            locs_matching_end = agg_ts.get_data_df(
-                                    "analysis/recreated_location",
-                                    geo_query=estg.GeoQuery(['data.loc'], poly_region_end),
-                                    time_query=tq,
-                                    extra_query_list=[not_excluded_uuid_query]
-                                )
-            locs_matching_end = locs_matching_end.drop_duplicates(subset=['section'])
-        esdsq.store_dashboard_time(
-            "admin/db_utils/query_segments_crossing_endpoints/fetch_end_locations",
-            stage3_timer
-        )
-
-        # Early returns in case of empty results are handled after timers exit
-        if locs_matching_start.empty:
-            result = locs_matching_start
-        elif locs_matching_end.empty:
-            result = locs_matching_end
-        else:
-            # Stage 4: Merge start and end locations
-            with ect.Timer() as stage4_timer:
-                merged = locs_matching_start.merge(locs_matching_end, how='outer', on=['section'])
-                filtered = merged.loc[merged['idx_x'] < merged['idx_y']].copy()
-                filtered['duration'] = filtered['ts_y'] - filtered['ts_x']
-                filtered['mode'] = filtered['mode_x']
-                filtered['start_fmt_time'] = filtered['fmt_time_x']
-                filtered['end_fmt_time'] = filtered['fmt_time_y']
-                filtered['user_id'] = filtered['user_id_y']
+        # Stage 3: Keep the sections that go through the zones in order. The
+        # zones are joined one at a time on their section index, so each join
+        # only considers the sections that passed all the previous zones.
+        if per_zone:
+            with ect.Timer() as stage3_timer:
+                first = zones_locations[0]
+                crossing = pd.DataFrame({
+                    'user_id': first['user_id'],
+                    'start_fmt_time': first['fmt_time'],
+                    'mode': first['mode'],
+                    'start_ts': first['ts'],
+                    'prev_idx': first['idx'],
+                    'prev_ts': first['ts'],
+                })
+                for (leg, zone_locations) in enumerate(zones_locations[1:], start=1):
+                    crossing = crossing.join(zone_locations[['idx', 'ts', 'fmt_time', 'user_id']],
+                                             how='inner', rsuffix='_zone')
+                    crossing = crossing.loc[crossing['prev_idx'] < crossing['idx']]
+                    crossing[f'leg_{leg}_duration'] = crossing['ts'] - crossing['prev_ts']
+                    crossing['prev_idx'] = crossing['idx']
+                    crossing['prev_ts'] = crossing['ts']
+                    crossing['end_fmt_time'] = crossing['fmt_time']
+                    crossing['user_id'] = crossing['user_id_zone']
+                    crossing = crossing.drop(columns=['idx', 'ts', 'fmt_time', 'user_id_zone'])
+                crossing['duration'] = crossing['prev_ts'] - crossing['start_ts']
+                legs = [f'leg_{leg}_duration' for leg in range(1, len(zones_locations))]
+                filtered = crossing.rename_axis('section').reset_index()[
+                    ['section', 'user_id', 'start_ts', 'start_fmt_time', 'end_fmt_time', 'mode', 'duration'] + legs
+                ]
             esdsq.store_dashboard_time(
-                "admin/db_utils/query_segments_crossing_endpoints/merge_and_filter_segments",
-                stage4_timer
+                "admin/db_utils/query_segments_crossing_zones/merge_and_filter_segments",
+                stage3_timer
             )
 
-            # Stage 5: Evaluate user count and determine if results should be returned
-            with ect.Timer() as stage5_timer:
-                number_user_seen = filtered.user_id_x.nunique()
-                if perm_utils.permissions.get("segment_trip_time_min_users", 0) <= number_user_seen:
-                    result = filtered
-                else:
-                    result = pd.DataFrame.from_dict([])
-            esdsq.store_dashboard_time(
-                "admin/db_utils/query_segments_crossing_endpoints/evaluate_user_count",
-                stage5_timer
-            )
+        # Stage 4: Evaluate user count and determine if results should be returned
+        with ect.Timer() as stage4_timer:
+            number_user_seen = filtered.user_id.nunique()
+            if not filtered.empty and perm_utils.permissions.get("segment_trip_time_min_users", 0) <= number_user_seen:
+                result = filtered
+            else:
+                result = pd.DataFrame.from_dict([])
+        esdsq.store_dashboard_time(
+            "admin/db_utils/query_segments_crossing_zones/evaluate_user_count",
+            stage4_timer
+        )
 
     # Ensure total time is always logged and the Timer exits before returning the result
     esdsq.store_dashboard_time(
-        "admin/db_utils/query_segments_crossing_endpoints/total_time",
+        "admin/db_utils/query_segments_crossing_zones/total_time",
         total_timer
     )
 
@@ -486,8 +727,99 @@ def query_segments_crossing_endpoints(poly_region_start, poly_region_end, start_
 # The following query can be called multiple times, let's open db only once
 analysis_timeseries_db = edb.get_analysis_timeseries_db()
 
-# Fetches sensed_mode for each section in a list
+# The inferred mode of a section does not change once it has been inferred,
+# so modes are cached in memory and in a SQLite file (SECTION_MODES_CACHE_PATH,
+# in CACHE_DIR by default) that is shared by the background callback
+# processes and persists across restarts
+_section_modes_cache = LRUCache(maxsize=100000)
+_section_modes_store = SqliteStore(
+    os.getenv('SECTION_MODES_CACHE_PATH', os.path.join(CACHE_DIR, 'section_modes.sqlite')),
+    'section_modes',
+)
+
+
+# Fetches sensed_mode for each section in a list, like
+# esds.cleaned2inferred_section_list but with a single query for all the
+# sections that are not cached yet
 # sections format example: [{'section': ObjectId('648d02b227fd2bb6635414a0'), 'user_id': UUID('6d7edf29-8b3f-451b-8d66-984cb8dd8906')}]
 def query_inferred_sections_modes(sections):
-    return esds.cleaned2inferred_section_list(sections)
+    with ect.Timer() as total_timer:
+        section_ids = {str(s['section']): s['section'] for s in sections}
+        user_ids = {str(s['section']): s['user_id'] for s in sections}
+        modes = {}
+        for section_id in section_ids:
+            mode = _section_modes_cache.get(section_id)
+            if mode is not None:
+                modes[section_id] = mode
+
+        missing = [section_id for section_id in section_ids if section_id not in modes]
+        if missing:
+            stored = _section_modes_store.get_many(missing)
+            for (section_id, mode) in stored.items():
+                modes[section_id] = _section_modes_cache.set(section_id, mode)
+            missing = [section_id for section_id in missing if section_id not in stored]
+
+        if missing:
+            logging.debug(f"Querying the inferred modes of {len(missing)} sections")
+            inferred_sections = analysis_timeseries_db.find(
+                {
+                    'metadata.key': 'analysis/inferred_section',
+                    # the users narrow the query down on the user_id index
+                    'user_id': {'$in': list({user_ids[section_id] for section_id in missing})},
+                    'data.cleaned_section': {'$in': [section_ids[section_id] for section_id in missing]},
+                },
+                {'data.cleaned_section': 1, 'data.sensed_mode': 1},
+            )
+            queried = {str(entry['data']['cleaned_section']): entry['data']['sensed_mode'] for entry in inferred_sections}
+            for (section_id, mode) in queried.items():
+                modes[section_id] = _section_modes_cache.set(section_id, mode)
+            if queried:
+                _section_modes_store.set_many(queried)
+    esdsq.store_dashboard_time(
+        "admin/db_utils/query_inferred_sections_modes/total_time",
+        total_timer
+    )
+
+    # sensed modes are stored as the values of PredictedModeTypes, which is
+    # what esds.cleaned2inferred_section_list returned. Sections that have
+    # not been inferred yet are not cached, so that they are queried again
+    # next time
+    return {
+        section_id: ecwmp.PredictedModeTypes(modes[section_id]) if section_id in modes else ecwmp.PredictedModeTypes.UNKNOWN
+        for section_id in section_ids
+    }
 
+
+
+def query_existing_tokens(tokens):
+    """
+    Returns the set of tokens that are already in the token db
+    """
+    existing = edb.get_token_db().find({'token': {'$in': list(tokens)}}, {'_id': 0, 'token': 1})
+    return {entry['token'] for entry in existing}
+
+
+def insert_new_tokens(tokens):
+    """
+    Inserts tokens in the token db, in the format of
+    esdt.insert_many_tokens, and returns the ones that were inserted.
+    The insert is unordered, so that a token that was inserted concurrently
+    (and is rejected by the unique index) does not stop the others.
+    """
+    if not tokens:
+        return []
+    try:
+        edb.get_token_db().insert_many([{'token': token} for token in tokens], ordered=False)
+        return list(tokens)
+    except BulkWriteError as e:
+        rejected = {tokens[error['index']] for error in e.details.get('writeErrors', [])}
+        logging.warning(f"{len(rejected)} of {len(tokens)} tokens could not be inserted")
+        return [token for token in tokens if token not in rejected]
+
+
+def count_tokens():
+    """
+    Returns the number of tokens in the token db, from its metadata (without
+    scanning it)
+    """
+    return edb.get_token_db().estimated_document_count()
@@ -0,0 +1,129 @@
+# export_utils.py
+import json
+import logging
+import os
+import tempfile
+from urllib.parse import quote
+
+import flask
+
+from utils.grid_utils import get_frame, apply_filter_model
+from utils.generate_qr_codes import iter_qrcodes_zip, iter_qrcodes_pdf
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+# Number of rows converted at a time, so that an export never holds more
+# than one chunk of text (or one Parquet row group) in memory
+EXPORT_CHUNK_ROWS = 10000
+# Parquet files are spooled to disk past this size before being sent
+PARQUET_SPOOL_BYTES = 64 * 1024 * 1024
+
+# Exports are served by Flask, outside of Dash callbacks, so that a long
+# download does not hold a callback worker. They serve the frames that the
+# data grids registered (see utils/grid_utils.py): columns the user is not
+# permitted to see were already dropped from those frames, and the frame
+# keys are only known to pages rendered for an authenticated user.
+export_blueprint = flask.Blueprint('export', __name__)
+
+
+def get_export_href(frame_key, filename, filter_model=None, qrcodes=False):
+    """
+    Return the path of the export of a registered frame (or of the QR codes
+    of its tokens), with the rows that match an AG Grid filter model
+    """
+    href = f'/export/{frame_key}/qrcodes/{filename}' if qrcodes else f'/export/{frame_key}/{filename}'
+    if filter_model:
+        href += '?filterModel=' + quote(json.dumps(filter_model))
+    return href
+
+
+def iter_csv_chunks(df):
+    """
+    Yield df as CSV text, EXPORT_CHUNK_ROWS rows at a time
+    """
+    for start in range(0, max(len(df), 1), EXPORT_CHUNK_ROWS):
+        yield df.iloc[start:start + EXPORT_CHUNK_ROWS].to_csv(index=False, header=(start == 0))
+
+
+def write_parquet(df, sink):
+    """
+    Write df to sink as Parquet, one row group per EXPORT_CHUNK_ROWS rows.
+    Object columns may mix types (or hold lists), so they are written as
+    strings.
+    """
+    df = df.astype({col: 'string' for col in df.columns if df[col].dtype == object})
+    schema = pa.Schema.from_pandas(df.iloc[:0], preserve_index=False)
+    with pq.ParquetWriter(sink, schema) as writer:
+        for start in range(0, len(df), EXPORT_CHUNK_ROWS):
+            chunk = df.iloc[start:start + EXPORT_CHUNK_ROWS]
+            writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+
+
+def get_filtered_frame(frame_key):
+    """
+    Return the rows of a registered frame that match the filterModel of the
+    request, or the error response to send instead
+    """
+    df = get_frame(frame_key)
+    if df is None:
+        return flask.Response("This table is no longer available; reload the page and try again.", status=404)
+    try:
+        filter_model = json.loads(flask.request.args.get('filterModel') or '{}')
+    except ValueError:
+        return flask.Response("Invalid filterModel", status=400)
+    return apply_filter_model(df, filter_model)
+
+
+@export_blueprint.route('/export/<frame_key>/<filename>')
+def export_frame(frame_key, filename):
+    df = get_filtered_frame(frame_key)
+    if isinstance(df, flask.Response):
+        return df
+    logging.debug(f"Exporting {len(df)} rows of frame {frame_key} as {filename}")
+
+    if filename.endswith('.csv'):
+        return flask.Response(
+            flask.stream_with_context(iter_csv_chunks(df)),
+            mimetype='text/csv',
+            headers={'Content-Disposition': f'attachment; filename="{filename}"'},
+        )
+    if filename.endswith('.parquet'):
+        if pq is None:
+            return flask.Response("Parquet export requires pyarrow to be installed", status=501)
+        sink = tempfile.SpooledTemporaryFile(max_size=PARQUET_SPOOL_BYTES)
+        write_parquet(df, sink)
+        sink.seek(0)
+        return flask.send_file(sink, mimetype='application/vnd.apache.parquet',
+                               as_attachment=True, download_name=filename)
+    return flask.Response(f"Unsupported export format: {filename}", status=400)
+
+
+@export_blueprint.route('/export/<frame_key>/qrcodes/<filename>')
+def export_qrcodes(frame_key, filename):
+    """
+    Stream the QR codes of the tokens of a registered frame (its 'token'
+    column), as a zip of PNGs or as a printable PDF sheet
+    """
+    formats = {
+        '.zip': (iter_qrcodes_zip, 'application/zip'),
+        '.pdf': (iter_qrcodes_pdf, 'application/pdf'),
+    }
+    extension = os.path.splitext(filename)[1]
+    if extension not in formats:
+        return flask.Response(f"Unsupported export format: {filename}", status=400)
+    df = get_filtered_frame(frame_key)
+    if isinstance(df, flask.Response):
+        return df
+    if 'token' not in df.columns:
+        return flask.Response("This table has no tokens", status=400)
+    logging.debug(f"Exporting the QR codes of {len(df)} tokens of frame {frame_key} as {filename}")
+    (iter_export, mimetype) = formats[extension]
+    return flask.Response(
+        flask.stream_with_context(iter_export(df['token'].tolist())),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'},
+    )
@@ -1,22 +1,224 @@
 import io
 import base64
+import logging
+import os
 import zipfile
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
 import qrcode
 
-def make_qrcode_base64_img(token):
-    url = f'nrelopenpath://login_token?token={token}'
+from utils.cache_utils import get_disk_cache
+
+# Below this number of QR codes to render, starting worker processes costs
+# more than rendering them in the current process
+QR_CODE_POOL_MIN = 64
+QR_CODE_WORKERS = os.cpu_count() or 1
+
+# Layout of the printable sheets of QR codes, in PDF points (US letter
+# pages): SHEET_COLUMNS x SHEET_ROWS QR codes per page, each above its token
+SHEET_PAGE_SIZE = (612, 792)
+SHEET_MARGIN = 36
+SHEET_COLUMNS = 3
+SHEET_ROWS = 4
+SHEET_QR_SIZE = 140
+SHEET_FONT_SIZE = 7
+# Courier glyphs are 0.6 em wide, so tokens are wrapped to the cell width
+SHEET_LINE_CHARS = int((SHEET_PAGE_SIZE[0] - 2 * SHEET_MARGIN) / SHEET_COLUMNS / (0.6 * SHEET_FONT_SIZE)) - 2
+
+# PNGs of the QR codes, keyed by token. A token's QR code never changes, so
+# exports only render the tokens that were never exported before.
+_qrcodes_cache = get_disk_cache('qrcodes')
+
+
+def make_qrcode_png(token):
+    url = get_login_url(token)
     img = qrcode.make(url,
                       error_correction=qrcode.constants.ERROR_CORRECT_H,
                       box_size=4)
     buffer = io.BytesIO()
     img.save(buffer)
-    return base64.b64encode(buffer.getvalue()).decode('utf-8')
-
-def make_qrcodes_zipfile(tokens):
-    def zip_directory(bytes_io):
-        with zipfile.ZipFile(bytes_io, mode="w") as zf:
-            for token in tokens:
-                qrcode = make_qrcode_base64_img(token)
-                image_data = base64.b64decode(qrcode)
-                zf.writestr(token + '.png', image_data)
-    return zip_directory
+    return buffer.getvalue()
+
+def get_login_url(token):
+    return f'nrelopenpath://login_token?token={token}'
+
+def make_qrcode_matrix(token):
+    """
+    Return the modules of the QR code of token (rows of booleans, True
+    being dark), without the quiet zone around them
+    """
+    qr = qrcode.QRCode(error_correction=qrcode.constants.ERROR_CORRECT_H, border=0)
+    qr.add_data(get_login_url(token))
+    return qr.get_matrix()
+
+def make_qrcode_base64_img(token):
+    return base64.b64encode(get_qrcode_pngs([token])[token]).decode('utf-8')
+
+def iter_qrcode_pngs(tokens):
+    """
+    Yield the (token, PNG bytes) of the QR codes of tokens, in order. Cached
+    QR codes are read from disk; the others are rendered by a pool of
+    processes, in order, so that the first ones are yielded while the next
+    ones are being rendered.
+    """
+    tokens = list(tokens)
+    missing = [token for token in tokens if token not in _qrcodes_cache]
+    logging.debug(f"Rendering {len(missing)} of {len(tokens)} QR codes")
+    if len(missing) < QR_CODE_POOL_MIN:
+        yield from _iter_cached_or_rendered(tokens, missing, map(make_qrcode_png, missing))
+        return
+    with ProcessPoolExecutor(max_workers=QR_CODE_WORKERS) as executor:
+        chunksize = max(1, len(missing) // (QR_CODE_WORKERS * 4))
+        rendered = executor.map(make_qrcode_png, missing, chunksize=chunksize)
+        yield from _iter_cached_or_rendered(tokens, missing, rendered)
+
+def _iter_cached_or_rendered(tokens, missing, rendered):
+    # rendered holds the PNGs of missing, which are in the order of tokens
+    missing = set(missing)
+    for token in tokens:
+        if token in missing:
+            png = next(rendered)
+            _qrcodes_cache.set(token, png)
+        else:
+            png = _qrcodes_cache.get(token)
+            if png is None:
+                # evicted from the cache since it was checked
+                png = make_qrcode_png(token)
+        yield (token, png)
+
+def get_qrcode_pngs(tokens):
+    return dict(iter_qrcode_pngs(tokens))
+
+class _ZipStream(io.RawIOBase):
+    """
+    A write-only stream that keeps what is written until it is taken, so
+    that a zip file can be sent while it is being written
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def take(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+def iter_qrcodes_zip(tokens):
+    """
+    Yield the bytes of a zip file of the QR codes of tokens (one <token>.png
+    per token) as it is written
+    """
+    stream = _ZipStream()
+    # PNGs are already compressed
+    with zipfile.ZipFile(stream, mode='w', compression=zipfile.ZIP_STORED) as zf:
+        for (token, png) in iter_qrcode_pngs(tokens):
+            zf.writestr(token + '.png', png)
+            yield stream.take()
+    yield stream.take()
+
+def _pdf_text(text):
+    return text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+def make_sheet_page_content(tokens):
+    """
+    Return the compressed PDF content stream of a page of the QR codes of
+    tokens (at most SHEET_COLUMNS x SHEET_ROWS). QR codes are drawn as
+    vector rectangles, one per horizontal run of dark modules.
+    """
+    (page_width, page_height) = SHEET_PAGE_SIZE
+    cell_width = (page_width - 2 * SHEET_MARGIN) / SHEET_COLUMNS
+    cell_height = (page_height - 2 * SHEET_MARGIN) / SHEET_ROWS
+    (drawings, texts) = ([], [])
+    for (i, token) in enumerate(tokens):
+        (row, column) = divmod(i, SHEET_COLUMNS)
+        left = SHEET_MARGIN + column * cell_width + (cell_width - SHEET_QR_SIZE) / 2
+        top = page_height - SHEET_MARGIN - row * cell_height
+        matrix = make_qrcode_matrix(token)
+        size = len(matrix)
+        # rectangles are in module units, from the bottom left of the QR code
+        drawings.append(f'q {SHEET_QR_SIZE / size:.4f} 0 0 {SHEET_QR_SIZE / size:.4f} '
+                        f'{left:.2f} {top - SHEET_QR_SIZE:.2f} cm')
+        for (y, modules) in enumerate(matrix):
+            x = 0
+            while x < size:
+                if not modules[x]:
+                    x += 1
+                    continue
+                start = x
+                while x < size and modules[x]:
+                    x += 1
+                drawings.append(f'{start} {size - 1 - y} {x - start} 1 re')
+        drawings.append('f Q')
+        text_left = SHEET_MARGIN + column * cell_width + 0.6 * SHEET_FONT_SIZE
+        for (line, start) in enumerate(range(0, len(token), SHEET_LINE_CHARS)):
+            baseline = top - SHEET_QR_SIZE - (line + 1.5) * SHEET_FONT_SIZE * 1.3
+            texts.append(f'BT /F1 {SHEET_FONT_SIZE} Tf {text_left:.2f} {baseline:.2f} Td '
+                         f'({_pdf_text(token[start:start + SHEET_LINE_CHARS])}) Tj ET')
+    content = '\n'.join(['0 g', *drawings, *texts])
+    return zlib.compress(content.encode('latin-1', errors='replace'))
+
+def iter_qrcodes_pdf(tokens):
+    """
+    Yield the bytes of a printable PDF of the QR codes of tokens, with their
+    token, as it is written. Pages are made by a pool of processes when there
+    are many of them.
+    """
+    tokens = list(tokens)
+    per_page = SHEET_COLUMNS * SHEET_ROWS
+    pages = [tokens[start:start + per_page] for start in range(0, len(tokens), per_page)]
+    # objects 1 to 3 are the catalog, the page tree and the font, followed by
+    # a page and its content for each page
+    page_ids = [4 + 2 * i for i in range(len(pages))]
+    offsets = []
+    written = 0
+
+    def write(obj_id, body):
+        nonlocal written
+        data = f'{obj_id} 0 obj\n'.encode() + body + b'\nendobj\n'
+        offsets.append(written)
+        written += len(data)
+        return data
+
+    def header():
+        nonlocal written
+        data = b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n'
+        written += len(data)
+        return data
+
+    yield header()
+    yield write(1, b'<< /Type /Catalog /Pages 2 0 R >>')
+    kids = ' '.join(f'{page_id} 0 R' for page_id in page_ids)
+    yield write(2, f'<< /Type /Pages /Kids [{kids}] /Count {len(pages)} >>'.encode())
+    yield write(3, b'<< /Type /Font /Subtype /Type1 /BaseFont /Courier >>')
+
+    def iter_contents(executor=None):
+        if executor is None:
+            return map(make_sheet_page_content, pages)
+        return executor.map(make_sheet_page_content, pages, chunksize=max(1, len(pages) // (QR_CODE_WORKERS * 4)))
+
+    def iter_page_objects(contents):
+        (page_width, page_height) = SHEET_PAGE_SIZE
+        for (page_id, content) in zip(page_ids, contents):
+            yield write(page_id, (f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {page_width} {page_height}] '
+                                  f'/Resources << /Font << /F1 3 0 R >> >> /Contents {page_id + 1} 0 R >>').encode())
+            yield write(page_id + 1, f'<< /Length {len(content)} /Filter /FlateDecode >>\nstream\n'.encode()
+                        + content + b'\nendstream')
+
+    logging.debug(f"Making a {len(pages)} pages sheet of {len(tokens)} QR codes")
+    if len(tokens) < QR_CODE_POOL_MIN:
+        yield from iter_page_objects(iter_contents())
+    else:
+        with ProcessPoolExecutor(max_workers=QR_CODE_WORKERS) as executor:
+            yield from iter_page_objects(iter_contents(executor))
+
+    xref = [f'xref\n0 {len(offsets) + 1}\n', '0000000000 65535 f \n']
+    xref += [f'{offset:010d} 00000 n \n' for offset in offsets]
+    yield (''.join(xref) + f'trailer\n<< /Size {len(offsets) + 1} /Root 1 0 R >>\nstartxref\n{written}\n%%EOF\n').encode()
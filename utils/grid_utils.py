@@ -0,0 +1,185 @@
+# grid_utils.py
+import itertools
+import json
+import logging
+import os
+import secrets
+
+import numpy as np
+import pandas as pd
+
+from utils.cache_utils import LRUCache
+
+# Number of rows the grids fetch per request
+GRID_BLOCK_SIZE = 100
+
+# Memory that each server process may use to keep the frames of the grids,
+# and the filtered and sorted views of those frames
+GRID_FRAMES_MAX_BYTES = int(os.getenv('GRID_FRAMES_MAX_MB', '512')) * 2 ** 20
+GRID_VIEWS_MAX_BYTES = int(os.getenv('GRID_VIEWS_MAX_MB', '128')) * 2 ** 20
+
+
+def frame_nbytes(df):
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+
+# Frames served to AG Grid's infinite row model. The grid only holds a key;
+# each block of rows it requests is cut from the frame kept here. A grid
+# whose frame was evicted has to be rendered again (see get_rows_block).
+_frames = LRUCache(maxsize=32, maxbytes=GRID_FRAMES_MAX_BYTES, sizeof=lambda entry: frame_nbytes(entry['df']))
+# Filtered and sorted views of those frames, so that scrolling through the
+# blocks of a view does not filter and sort it again for every block.
+# Views are keyed by the version of their frame, which changes whenever the
+# frame registered under a key is updated.
+_views = LRUCache(maxsize=16, maxbytes=GRID_VIEWS_MAX_BYTES, sizeof=frame_nbytes)
+_versions = itertools.count()
+
+# Shown by the grids whose frame is no longer held by the server
+GRID_FRAME_EXPIRED_MESSAGE = "This table has expired. Reload the page to see its rows again."
+
+
+def register_frame(df):
+    """
+    Keep df in this process for the grid to fetch rows from, and return the
+    key that the grid should use to request them
+    """
+    key = secrets.token_hex(8)
+    update_frame(key, df)
+    return key
+
+
+def update_frame(key, df):
+    """
+    Replace the frame registered under key, e.g. to append rows to it
+    """
+    _frames.set(key, {'df': df, 'version': next(_versions)})
+
+
+def get_frame(key):
+    """
+    Return the frame registered under key, or None if it is not (or no
+    longer) held by this process
+    """
+    entry = _frames.get(key) if key else None
+    return entry['df'] if entry else None
+
+
+def _text_condition(values, condition):
+    kind = condition.get('type')
+    text = values.fillna('').astype(str).str.lower()
+    query = str(condition.get('filter') or '').lower()
+    if kind == 'blank':
+        return values.isna() | (text == '')
+    if kind == 'notBlank':
+        return values.notna() & (text != '')
+    if kind == 'equals':
+        return text == query
+    if kind == 'notEqual':
+        return text != query
+    if kind == 'startsWith':
+        return text.str.startswith(query)
+    if kind == 'endsWith':
+        return text.str.endswith(query)
+    if kind == 'notContains':
+        return ~text.str.contains(query, regex=False)
+    return text.str.contains(query, regex=False)
+
+
+def _number_condition(values, condition):
+    kind = condition.get('type')
+    numbers = pd.to_numeric(values, errors='coerce')
+    if kind == 'blank':
+        return numbers.isna()
+    if kind == 'notBlank':
+        return numbers.notna()
+    (low, high) = (condition.get('filter'), condition.get('filterTo'))
+    comparisons = {
+        'equals': lambda: numbers == low,
+        'notEqual': lambda: numbers != low,
+        'lessThan': lambda: numbers < low,
+        'lessThanOrEqual': lambda: numbers <= low,
+        'greaterThan': lambda: numbers > low,
+        'greaterThanOrEqual': lambda: numbers >= low,
+        'inRange': lambda: (numbers >= low) & (numbers <= high),
+    }
+    if kind not in comparisons:
+        logging.warning(f"Unsupported number filter type {kind}; ignoring it")
+        return pd.Series(True, index=values.index)
+    return comparisons[kind]()
+
+
+def _column_mask(values, column_filter):
+    if 'conditions' in column_filter:
+        masks = [_column_mask(values, {'filterType': column_filter.get('filterType'), **condition})
+                 for condition in column_filter['conditions']]
+        if column_filter.get('operator') == 'OR':
+            return np.logical_or.reduce(masks)
+        return np.logical_and.reduce(masks)
+    if column_filter.get('filterType') == 'number':
+        return _number_condition(values, column_filter)
+    return _text_condition(values, column_filter)
+
+
+def apply_filter_model(df, filter_model):
+    """
+    Return the rows of df matching an AG Grid filter model (text and number
+    column filters, including combined conditions)
+    """
+    if not filter_model:
+        return df
+    mask = np.ones(len(df), dtype=bool)
+    for (col, column_filter) in filter_model.items():
+        if col not in df.columns:
+            continue
+        mask &= np.asarray(_column_mask(df[col], column_filter), dtype=bool)
+    return df[mask]
+
+
+def apply_sort_model(df, sort_model):
+    """
+    Return df sorted by an AG Grid sort model; missing values sort last
+    """
+    sort_model = [s for s in (sort_model or []) if s.get('colId') in df.columns]
+    if not sort_model:
+        return df
+    by = [s['colId'] for s in sort_model]
+    ascending = [s.get('sort') != 'desc' for s in sort_model]
+    try:
+        return df.sort_values(by=by, ascending=ascending, na_position='last', kind='stable')
+    except TypeError:
+        # columns mixing types (e.g. numbers and strings) sort as strings
+        return df.sort_values(by=by, ascending=ascending, na_position='last', kind='stable',
+                              key=lambda s: s.astype(str))
+
+
+def get_rows_block(key, request):
+    """
+    Answer an AG Grid infinite row model request (startRow, endRow,
+    filterModel, sortModel) with a block of rows of the frame registered
+    under key and the number of rows matching the filters, or None if the
+    frame is not (or no longer) held by this process
+    """
+    entry = _frames.get(key) if key else None
+    if entry is None:
+        logging.warning(f"Grid frame {key} is not available in this process; serving no rows")
+        return None
+
+    df = entry['df']
+    if not request.get('filterModel') and not request.get('sortModel'):
+        # the frame itself, which does not need another copy in _views
+        view = df
+    else:
+        view_key = (entry['version'], json.dumps(request.get('filterModel') or {}, sort_keys=True),
+                    json.dumps(request.get('sortModel') or []))
+        view = _views.get_or_create(
+            view_key,
+            lambda: apply_sort_model(apply_filter_model(df, request.get('filterModel')), request.get('sortModel')),
+        )
+    (start, end) = (request.get('startRow', 0), request.get('endRow', GRID_BLOCK_SIZE))
+    block = view.iloc[start:end]
+    # missing values are only filled in the rows sent to the browser, so
+    # that the frame keeps its dtypes for filtering and sorting
+    return {
+        'rowData': block.astype(object).where(block.notna(), 'N/A').to_dict('records'),
+        'rowCount': len(view),
+    }
@@ -1,5 +1,7 @@
 import requests
 import logging
+from dataclasses import dataclass
+from types import MappingProxyType
 from utils import constants
 
 import emission.analysis.configs.dynamic_config as eacd
@@ -34,7 +36,7 @@ def has_permission(perm):
     return False if permissions.get(perm) is False else True
 
 
-def get_allowed_named_trip_columns():
+def _get_allowed_named_trip_columns():
     if surveyinfo["trip-labels"] == "MULTILABEL":
         return constants.MULTILABEL_NAMED_COLS
     elif surveyinfo["trip-labels"] == "ENKETO":
@@ -47,55 +49,95 @@ def get_allowed_named_trip_columns():
         return permissions.get('additional_trip_columns', [])
 
 def get_required_columns():
-    required_cols = ['user_id']
-    required_cols.extend(col['path'] for col in constants.REQUIRED_NAMED_COLS)
-    return required_cols
+    return list(column_plan.required_trip_columns)
+
+
+def get_allowed_named_trip_columns():
+    return [{'label': label, 'path': path} for (label, path) in column_plan.allowed_named_trip_columns]
 
 
 def get_all_named_trip_columns():
-    named_columns = [item for item in constants.REQUIRED_NAMED_COLS]
-    named_columns.extend(
-        get_allowed_named_trip_columns()
-    )
-    return named_columns
+    return [{'label': label, 'path': path} for (label, path) in column_plan.named_trip_columns]
+
 
 def get_all_trip_columns():
-    columns = get_allowed_trip_columns()
-    columns.extend([col['path'] for col in get_allowed_named_trip_columns()
-                    if col['path'] not in columns])
-    columns.extend([col for col in get_required_columns()
-                    if col not in columns])
-    logging.debug("get_all_trip_columns: after additional columns, curr set is %s" % columns)
-    return columns
+    return list(column_plan.all_trip_columns)
 
 
 def get_allowed_trip_columns():
-    columns = list(constants.VALID_TRIP_COLS)
-    for column in permissions.get("data_trips_columns_exclude", []):
-        columns.remove(column)
-    for column in permissions.get("additional_trip_columns", []):
-        if column not in columns:
-            columns.append(column)
-    logging.debug("allowed trip columns are %s" % columns)
-    return columns
+    return list(column_plan.allowed_trip_columns)
 
 
 def get_uuids_columns():
-    columns = list(constants.VALID_UUIDS_COLS)
-    for column in permissions.get("data_uuids_columns_exclude", []):
-        columns.remove(column)
-    return columns
+    return list(column_plan.uuids_columns)
+
 
 def get_demographic_columns(columns):
-    for column in permissions.get("data_demographics_columns_exclude", []):
-        columns.remove(column)
-    return columns
+    return [c for c in columns if c not in column_plan.excluded_demographics_columns]
+
 
 def get_trajectories_columns(columns):
-    columns = list(columns)
-    for column in permissions.get("data_trajectories_columns_exclude", []):
-        columns.remove(column)
-    return columns
+    return [c for c in columns if c not in column_plan.excluded_trajectories_columns]
+
+
+@dataclass(frozen=True)
+class ColumnPlan:
+    """
+    The columns of the data tables allowed by the permissions, resolved once
+    at startup. Column lists are ordered tuples, with frozensets for
+    membership tests.
+    """
+    required_trip_columns: tuple
+    # (label, path) pairs
+    allowed_named_trip_columns: tuple
+    named_trip_columns: tuple
+    allowed_trip_columns: tuple
+    allowed_trip_columns_set: frozenset
+    all_trip_columns: tuple
+    all_trip_columns_set: frozenset
+    # maps the fields of confirmed trips, as returned by get_data_df (without
+    # the "data." prefix), to the trip column names
+    trip_rename: MappingProxyType
+    uuids_columns: tuple
+    excluded_demographics_columns: frozenset
+    excluded_trajectories_columns: frozenset
+
+
+def _without_excluded(columns, excluded):
+    excluded = set(excluded)
+    return tuple(c for c in columns if c not in excluded)
+
+
+def build_column_plan():
+    required = ('user_id',) + tuple(col['path'] for col in constants.REQUIRED_NAMED_COLS)
+    allowed_named = tuple((col['label'], col['path']) for col in (_get_allowed_named_trip_columns() or [])
+                          if isinstance(col, dict))
+    named = tuple((col['label'], col['path']) for col in constants.REQUIRED_NAMED_COLS) + allowed_named
+
+    allowed = list(_without_excluded(constants.VALID_TRIP_COLS, permissions.get("data_trips_columns_exclude", [])))
+    allowed.extend(c for c in permissions.get("additional_trip_columns", []) if c not in allowed)
+    all_columns = list(allowed)
+    all_columns.extend(path for (_, path) in allowed_named if path not in all_columns)
+    all_columns.extend(c for c in required if c not in all_columns)
+    logging.debug("Trip columns: allowed %s, all %s" % (allowed, all_columns))
+
+    return ColumnPlan(
+        required_trip_columns=required,
+        allowed_named_trip_columns=allowed_named,
+        named_trip_columns=named,
+        allowed_trip_columns=tuple(allowed),
+        allowed_trip_columns_set=frozenset(allowed),
+        all_trip_columns=tuple(all_columns),
+        all_trip_columns_set=frozenset(all_columns),
+        trip_rename=MappingProxyType({c.replace("data.", ""): c for c in constants.VALID_TRIP_COLS}),
+        uuids_columns=_without_excluded(constants.VALID_UUIDS_COLS, permissions.get("data_uuids_columns_exclude", [])),
+        excluded_demographics_columns=frozenset(permissions.get("data_demographics_columns_exclude", [])),
+        excluded_trajectories_columns=frozenset(permissions.get("data_trajectories_columns_exclude", [])),
+    )
+
+
+column_plan = build_column_plan()
+
 
 def get_token_prefix():
     return permissions.get('token_prefix', 'nrelop')
\ No newline at end of file
@@ -0,0 +1,85 @@
+# push_utils.py
+import logging
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Recipients are sent notifications PUSH_BATCH_SIZE at a time, with at most
+# PUSH_WORKERS batches being sent concurrently
+PUSH_BATCH_SIZE = int(os.getenv('PUSH_BATCH_SIZE', '500'))
+PUSH_WORKERS = int(os.getenv('PUSH_WORKERS', '4'))
+# A batch that fails is retried PUSH_RETRIES times, waiting PUSH_RETRY_DELAY
+# seconds before the first retry and twice as long before each next one
+PUSH_RETRIES = 3
+PUSH_RETRY_DELAY = 1
+
+# 'emission' sends notifications through the e-mission server's push
+# service; 'stub' only logs them, to use the page without a push service
+PUSH_BACKEND = os.getenv('PUSH_BACKEND', 'emission')
+# Fraction of the batches that the stub backend fails, to exercise retries
+PUSH_STUB_FAILURE_RATE = float(os.getenv('PUSH_STUB_FAILURE_RATE', '0'))
+
+
+def send_with_emission(uuid_list, title, message, survey_spec):
+    import emission.net.ext_service.push.notify_usage as pnu
+    response = pnu.send_visible_notification_to_users(uuid_list, title, message, survey_spec)
+    pnu.display_response(response)
+    return response
+
+
+def send_with_stub(uuid_list, title, message, survey_spec):
+    if random.random() < PUSH_STUB_FAILURE_RATE:
+        raise RuntimeError("stub push backend failure")
+    logging.info(f"Stub push of {title!r} ({survey_spec}) to {len(uuid_list)} users")
+    return {'success': len(uuid_list)}
+
+
+PUSH_BACKENDS = {
+    'emission': send_with_emission,
+    'stub': send_with_stub,
+}
+
+
+def get_push_backend():
+    if PUSH_BACKEND not in PUSH_BACKENDS:
+        raise ValueError(f"Unknown PUSH_BACKEND {PUSH_BACKEND}, expected one of {list(PUSH_BACKENDS)}")
+    return PUSH_BACKENDS[PUSH_BACKEND]
+
+
+def _send_batch(send, batch, title, message, survey_spec):
+    """
+    Send a batch, retrying it if it fails. Returns the number of attempts and
+    the error of the last one, if it failed.
+    """
+    for attempt in range(PUSH_RETRIES + 1):
+        if attempt > 0:
+            time.sleep(PUSH_RETRY_DELAY * 2 ** (attempt - 1))
+        try:
+            send(batch, title, message, survey_spec)
+            return (attempt + 1, None)
+        except Exception as e:
+            logging.warning(f"Push to a batch of {len(batch)} users failed (attempt {attempt + 1}): {e}")
+            error = e
+    return (PUSH_RETRIES + 1, error)
+
+
+def send_in_batches(uuid_list, title, message, survey_spec, send=None):
+    """
+    Send a notification to uuid_list in batches of PUSH_BATCH_SIZE, sent
+    concurrently by PUSH_WORKERS threads. Yields a dict for each batch, as
+    it completes, with its number, its size, the number of attempts it took
+    and the error of its last attempt, if it failed.
+    """
+    send = send or get_push_backend()
+    batches = [uuid_list[start:start + PUSH_BATCH_SIZE] for start in range(0, len(uuid_list), PUSH_BATCH_SIZE)]
+    with ThreadPoolExecutor(max_workers=PUSH_WORKERS) as executor:
+        futures = {
+            executor.submit(_send_batch, send, batch, title, message, survey_spec): (i, batch)
+            for (i, batch) in enumerate(batches)
+        }
+        for future in as_completed(futures):
+            (i, batch) = futures[future]
+            (attempts, error) = future.result()
+            yield {'batch': i + 1, 'batches': len(batches), 'size': len(batch),
+                   'attempts': attempts, 'error': error}
@@ -0,0 +1,243 @@
+# spatial_utils.py
+import hashlib
+import logging
+
+import numpy as np
+
+from utils.cache_utils import LRUCache
+
+# Average number of points per grid cell; smaller cells make bbox queries
+# tighter at the cost of a larger cell table
+POINTS_PER_CELL = 64
+
+# Point clusters are computed on a web mercator grid whose cells are
+# 2 ** -CLUSTER_CELL_BITS of a tile wide (32px for mapbox's 512px tiles).
+# Cells nest across zoom levels, so the clusters at zoom z are exactly the
+# union of the clusters at zoom z + 1, as in supercluster.
+CLUSTER_CELL_BITS = 4
+# From this zoom level on, points are drawn individually
+CLUSTER_MAX_ZOOM = 15
+
+# Indexes are keyed by a hash of their coordinates, so that every callback
+# working on the same trips shares the same index
+_index_cache = LRUCache(maxsize=8)
+_clusters_cache = LRUCache(maxsize=8)
+
+
+class GridIndex:
+    """
+    A uniform grid over point coordinates that answers "which points are in
+    this bounding box" queries.
+    Points are sorted by cell so that each row of cells covered by a query is
+    a single contiguous slice of the sorted point order.
+    """
+
+    def __init__(self, lon, lat, points_per_cell=POINTS_PER_CELL):
+        self.lon = np.asarray(lon, dtype=float)
+        self.lat = np.asarray(lat, dtype=float)
+        valid = np.isfinite(self.lon) & np.isfinite(self.lat)
+        n_valid = int(valid.sum())
+
+        if n_valid > 0:
+            self.min_lon, self.max_lon = self.lon[valid].min(), self.lon[valid].max()
+            self.min_lat, self.max_lat = self.lat[valid].min(), self.lat[valid].max()
+        else:
+            self.min_lon = self.max_lon = self.min_lat = self.max_lat = 0.0
+
+        side = max(1, int(np.ceil(np.sqrt(n_valid / points_per_cell))))
+        self.nx = self.ny = side
+        self.cell_width = max((self.max_lon - self.min_lon) / side, 1e-9)
+        self.cell_height = max((self.max_lat - self.min_lat) / side, 1e-9)
+
+        ix = self._col(np.where(valid, self.lon, self.min_lon))
+        iy = self._row(np.where(valid, self.lat, self.min_lat))
+        # invalid points go to an extra cell past the end that is never queried
+        cells = np.where(valid, iy * self.nx + ix, self.nx * self.ny)
+        self.order = np.argsort(cells, kind='stable')
+        self.cell_starts = np.searchsorted(cells[self.order], np.arange(self.nx * self.ny + 1))
+
+    def __len__(self):
+        return len(self.lon)
+
+    def _col(self, lon):
+        return np.clip(((lon - self.min_lon) / self.cell_width).astype(int), 0, self.nx - 1)
+
+    def _row(self, lat):
+        return np.clip(((lat - self.min_lat) / self.cell_height).astype(int), 0, self.ny - 1)
+
+    def query(self, west, south, east, north):
+        """
+        Return the sorted indices of the points inside the bounding box.
+        Mapbox reports views that cross the antimeridian with longitudes
+        beyond +/-180, so those are split into two boxes.
+        """
+        if east - west >= 360:
+            (west, east) = (-180, 180)
+        elif east > 180:
+            return np.union1d(self.query(west, south, 180, north),
+                              self.query(-180, south, east - 360, north))
+        elif west < -180:
+            return np.union1d(self.query(west + 360, south, 180, north),
+                              self.query(-180, south, east, north))
+        if (len(self) == 0 or east < self.min_lon or west > self.max_lon
+                or north < self.min_lat or south > self.max_lat):
+            return np.array([], dtype=int)
+
+        (ix0, ix1) = self._col(np.array([west, east]))
+        (iy0, iy1) = self._row(np.array([south, north]))
+        slices = [
+            self.order[self.cell_starts[iy * self.nx + ix0]:self.cell_starts[iy * self.nx + ix1 + 1]]
+            for iy in range(iy0, iy1 + 1)
+        ]
+        candidates = np.concatenate(slices)
+        # cells on the edge of the box are only partially covered
+        lon, lat = self.lon[candidates], self.lat[candidates]
+        inside = (lon >= west) & (lon <= east) & (lat >= south) & (lat <= north)
+        return np.sort(candidates[inside])
+
+
+class PointClusters:
+    """
+    Hierarchical grid clustering of points for zoom levels below
+    CLUSTER_MAX_ZOOM.
+    Only the cell of each point at the finest level is stored; the cell at a
+    coarser zoom level is obtained by dropping low bits.
+    """
+
+    def __init__(self, lon, lat):
+        self.lon = np.asarray(lon, dtype=float)
+        self.lat = np.asarray(lat, dtype=float)
+        self.bits = CLUSTER_MAX_ZOOM + CLUSTER_CELL_BITS
+        (x, y) = mercator_xy(self.lon, self.lat)
+        scale = 2 ** self.bits
+        # invalid points end up in cell 0; callers filter them out beforehand
+        self.cell_x = np.clip(np.nan_to_num(x * scale), 0, scale - 1).astype(np.int64)
+        self.cell_y = np.clip(np.nan_to_num(y * scale), 0, scale - 1).astype(np.int64)
+
+    def clusters(self, zoom, point_indices, categories):
+        """
+        Group the given points into clusters for the zoom level.
+        categories holds an integer category (e.g. a mode code) for each of
+        point_indices.
+        Returns a dict of arrays with one entry per cluster: lon/lat centroid,
+        count, the dominant category and the index of one member point.
+        """
+        point_indices = np.asarray(point_indices, dtype=int)
+        categories = np.asarray(categories, dtype=int)
+        cells = self.cells(zoom, point_indices)
+        (cell_ids, first_member, inverse) = np.unique(cells, return_index=True, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        n_clusters = len(cell_ids)
+        count = np.bincount(inverse, minlength=n_clusters)
+        n_categories = int(categories.max()) + 1 if len(categories) else 1
+        by_category = np.bincount(inverse * n_categories + categories,
+                                  minlength=n_clusters * n_categories)
+        return {
+            'lon': np.bincount(inverse, self.lon[point_indices], n_clusters) / count,
+            'lat': np.bincount(inverse, self.lat[point_indices], n_clusters) / count,
+            'count': count,
+            'category': by_category.reshape(n_clusters, n_categories).argmax(axis=1),
+            'member': point_indices[first_member],
+        }
+
+    def cells(self, zoom, point_indices):
+        """
+        Return the id of the grid cell of each of the points at a zoom level
+        """
+        shift = self.bits - (self._level(zoom) + CLUSTER_CELL_BITS)
+        return ((self.cell_x[point_indices] >> shift) << self.bits) | (self.cell_y[point_indices] >> shift)
+
+    def cell_centers(self, zoom, cells):
+        """
+        Return the lon and lat of the center of cells returned by cells()
+        """
+        scale = 2 ** (self._level(zoom) + CLUSTER_CELL_BITS)
+        x = ((cells >> self.bits) + 0.5) / scale
+        y = ((cells & (2 ** self.bits - 1)) + 0.5) / scale
+        return mercator_lonlat(x, y)
+
+    @staticmethod
+    def _level(zoom):
+        return max(0, min(int(zoom), CLUSTER_MAX_ZOOM))
+
+
+def mercator_xy(lon, lat):
+    """
+    Project lon/lat to web mercator coordinates normalized to [0, 1]
+    """
+    lat = np.clip(lat, -85.0511, 85.0511)
+    x = (lon + 180) / 360
+    y = 0.5 - np.log(np.tan(np.pi / 4 + np.radians(lat) / 2)) / (2 * np.pi)
+    return x, y
+
+
+def mercator_lonlat(x, y):
+    """
+    Inverse of mercator_xy
+    """
+    lon = x * 360 - 180
+    lat = np.degrees(2 * np.arctan(np.exp((0.5 - y) * 2 * np.pi)) - np.pi / 2)
+    return lon, lat
+
+
+def coordinates_key(lon, lat):
+    """
+    Return a short content hash identifying a set of point coordinates
+    """
+    digest = hashlib.sha1()
+    digest.update(np.ascontiguousarray(lon, dtype=float).tobytes())
+    digest.update(np.ascontiguousarray(lat, dtype=float).tobytes())
+    return digest.hexdigest()[:16]
+
+
+def get_grid_index(key, get_coordinates):
+    """
+    Return the cached index for key. If this process has not built it yet (or
+    it has been evicted), build it from the (lon, lat) returned by
+    get_coordinates(), which is only called in that case
+    """
+    def build():
+        (lon, lat) = get_coordinates()
+        logging.debug(f"Building grid index {key} over {len(lon)} points")
+        return GridIndex(lon, lat)
+    return _index_cache.get_or_create(key, build)
+
+
+def get_point_clusters(key, get_coordinates):
+    """
+    Return the cached PointClusters for key, building it from the (lon, lat)
+    returned by get_coordinates() if needed
+    """
+    def build():
+        (lon, lat) = get_coordinates()
+        logging.debug(f"Building point clusters {key} over {len(lon)} points")
+        return PointClusters(lon, lat)
+    return _clusters_cache.get_or_create(key, build)
+
+
+def viewport_from_relayout(relayout_data):
+    """
+    Return the (west, south, east, north) bounds of a mapbox figure from its
+    relayoutData, or None if the event does not describe the visible area
+    (e.g. an autosize event on first render)
+    """
+    if not relayout_data:
+        return None
+    corners = (relayout_data.get('mapbox._derived') or {}).get('coordinates')
+    if not corners:
+        return None
+    lons = [c[0] for c in corners]
+    lats = [c[1] for c in corners]
+    return (min(lons), min(lats), max(lons), max(lats))
+
+
+def sample_evenly(indices, max_count):
+    """
+    Return at most max_count entries of indices, evenly spaced so that the
+    sample keeps the spatial spread of the (index-ordered) input
+    """
+    indices = np.asarray(indices)
+    if len(indices) <= max_count:
+        return indices
+    positions = np.linspace(0, len(indices) - 1, max_count).astype(int)
+    return indices[positions]
@@ -0,0 +1,97 @@
+# stats_utils.py
+import itertools
+
+import numpy as np
+import pandas as pd
+
+# Percentiles computed for each group of a statistics cube, with the name of
+# their column
+CUBE_PERCENTILES = {'p10': 0.10, 'p25': 0.25, 'median': 0.50, 'p75': 0.75, 'p90': 0.90}
+
+
+def ts_hour_month(ts):
+    """
+    Return the UTC hour of the day and month of numeric timestamps (seconds)
+    """
+    seconds = np.asarray(ts, dtype='float64').astype('int64')
+    hour = (seconds // 3600) % 24
+    month = seconds.astype('datetime64[s]').astype('datetime64[M]').astype('int64') % 12 + 1
+    return hour, month
+
+
+def _group_percentiles(values, starts, counts):
+    """
+    Return the percentiles of groups of values, each group being the sorted
+    slice values[start:start + count], interpolated linearly as pandas does
+    """
+    percentiles = {}
+    for (name, q) in CUBE_PERCENTILES.items():
+        position = starts + q * (counts - 1)
+        low = np.floor(position).astype(int)
+        high = np.ceil(position).astype(int)
+        percentiles[name] = values[low] + (values[high] - values[low]) * (position - low)
+    return percentiles
+
+
+def _grouping_stats(values, codes, labels, by):
+    """
+    Return the statistics of values grouped by the dimensions in by.
+    values are sorted, and they stay sorted within each group since groups
+    are formed with a stable sort.
+    """
+    if by:
+        keys = np.ravel_multi_index([codes[name] for name in by], [len(labels[name]) for name in by])
+        order = np.argsort(keys, kind='stable')
+        (keys, values) = (keys[order], values[order])
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    else:
+        keys = np.zeros(len(values), dtype=int)
+        starts = np.array([0])
+    counts = np.diff(np.r_[starts, len(values)])
+
+    stats = {'grouping': [by] * len(starts)}
+    group_codes = np.unravel_index(keys[starts], [len(labels[name]) for name in by]) if by else []
+    for (name, dim_codes) in zip(by, group_codes):
+        stats[name] = labels[name][dim_codes].astype(object)
+    stats['count'] = counts
+    stats.update(_group_percentiles(values, starts, counts))
+    stats['iqr'] = stats['p75'] - stats['p25']
+    return pd.DataFrame(stats)
+
+
+def stats_cube(values, dimensions):
+    """
+    Return the count and percentiles of values for every combination of the
+    labels of dimensions (a dict of name -> label of each value), and for
+    every subset of the dimensions, as in SQL's GROUP BY CUBE.
+    Each row of the cube has a 'grouping' column holding the tuple of the
+    dimensions it is grouped by; use cube_slice to read the groups of one
+    combination of dimensions.
+    Values are sorted once; each grouping then only needs a stable sort of
+    integer group keys, which keeps values sorted within their group so that
+    percentiles are read directly at their positions.
+    """
+    values = np.asarray(values, dtype='float64')
+    order = np.argsort(values, kind='stable')
+    values = values[order]
+    (codes, labels) = ({}, {})
+    for (name, dimension) in dimensions.items():
+        (labels[name], codes[name]) = np.unique(np.asarray(dimension)[order], return_inverse=True)
+        codes[name] = codes[name].reshape(-1)
+
+    if len(values) == 0:
+        return pd.DataFrame(columns=['grouping', *dimensions, 'count', *CUBE_PERCENTILES, 'iqr'])
+    groupings = [by for size in range(len(dimensions) + 1)
+                 for by in itertools.combinations(dimensions, size)]
+    return pd.concat([_grouping_stats(values, codes, labels, by) for by in groupings], ignore_index=True)
+
+
+def cube_slice(cube, by):
+    """
+    Return the groups of a stats_cube for one combination of dimensions,
+    e.g. cube_slice(cube, ('mode', 'hour')); by=() gives the overall
+    statistics
+    """
+    by = tuple(by)
+    rows = cube.loc[cube['grouping'].map(lambda grouping: grouping == by).astype(bool)]
+    return rows[[*by, 'count', *CUBE_PERCENTILES, 'iqr']].reset_index(drop=True)
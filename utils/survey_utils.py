@@ -0,0 +1,180 @@
+# survey_utils.py
+import logging
+import operator
+
+import pandas as pd
+
+from utils import constants
+from utils import permissions as perm_utils
+
+# Column plans of the surveys, keyed by (survey key, survey version), with
+# the leaf paths they were built from and the extractor reading their columns.
+# The fields of a survey are mostly those of its form, but optional
+# questions only appear in the entries that answer them, so a plan is
+# extended when entries bring keys that it does not know.
+_column_plans = {}
+
+
+def iter_leaf_paths(doc, prefix=()):
+    """
+    Yield the path (tuple of keys) of every non-dict value nested in doc,
+    which are the columns pd.json_normalize would create for it
+    """
+    for (key, value) in doc.items():
+        path = prefix + (key,)
+        if isinstance(value, dict):
+            yield from iter_leaf_paths(value, path)
+        else:
+            yield path
+
+
+def build_column_plan(paths):
+    """
+    Return the (column name, path) of the columns of the demographics table
+    for the leaf paths of the entries of one survey version, without
+    metadata, permission-excluded or EXCLUDED_DEMOGRAPHICS_COLS columns, and
+    with the survey answers named by their question only
+    """
+    excluded = perm_utils.column_plan.excluded_demographics_columns
+    (plan, names) = ([], set())
+    for path in paths:
+        name = '.'.join(path)
+        if name.startswith('metadata') or name in excluded:
+            continue
+        if name.startswith('data.jsonDocResponse.'):
+            name = path[-1]
+        # questions with the same name in different groups would produce
+        # duplicate columns; the first one is kept
+        if name in constants.EXCLUDED_DEMOGRAPHICS_COLS or name in names:
+            continue
+        names.add(name)
+        plan.append((name, path))
+    return plan
+
+
+def _make_getter(keys):
+    if len(keys) == 0:
+        return lambda doc: ()
+    if len(keys) == 1:
+        (key,) = keys
+        return lambda doc: (doc[key],)
+    return operator.itemgetter(*keys)
+
+
+def build_extractor(paths, plan):
+    """
+    Return a tree of the dicts nested in the entries of a survey version,
+    from their known leaf paths. Each node has the known keys of its dict,
+    the keys of its leaves that are columns of plan, and its child nodes;
+    'paths' lists the paths of the values that extract_row reads, in order.
+    """
+    def new_node():
+        return {'keys': set(), 'leaves': [], 'children': {}}
+
+    root = new_node()
+    for path in paths:
+        node = root
+        for key in path[:-1]:
+            node['keys'].add(key)
+            node = node['children'].setdefault(key, new_node())
+        node['keys'].add(path[-1])
+    for (_, path) in plan:
+        node = root
+        for key in path[:-1]:
+            node = node['children'][key]
+        node['leaves'].append(path[-1])
+
+    def finish(node, prefix):
+        node['getter'] = _make_getter(node['leaves'])
+        node['paths'] = [prefix + (key,) for key in node['leaves']]
+        for (key, child) in node['children'].items():
+            finish(child, prefix + (key,))
+            node['paths'].extend(child['paths'])
+
+    finish(root, ())
+    return root
+
+
+def extract_row(node, doc, row):
+    """
+    Append to row the values of doc at the paths of node, in order. Returns
+    False if doc has keys that node does not know.
+    """
+    keys = doc.keys()
+    if keys == node['keys']:
+        row.extend(node['getter'](doc))
+    elif keys <= node['keys']:
+        row.extend([doc.get(key) for key in node['leaves']])
+    else:
+        return False
+    for (key, child) in node['children'].items():
+        value = doc.get(key)
+        if isinstance(value, dict):
+            if not extract_row(child, value, row):
+                return False
+        else:
+            row.extend([None] * len(child['paths']))
+    return True
+
+
+def get_column_plan(survey_key, version, entries=()):
+    """
+    Return the cached column plan of a survey version and its extractor,
+    extending them with the leaf paths of entries
+    """
+    plan_key = (survey_key, version)
+    (paths, plan, extractor) = _column_plans.get(plan_key, ({}, None, None))
+    new_paths = dict.fromkeys(path for entry in entries for path in iter_leaf_paths(entry)
+                              if path not in paths)
+    if plan is None or new_paths:
+        # the known paths keep their order, so the columns keep theirs
+        paths = {**paths, **new_paths}
+        plan = build_column_plan(list(paths))
+        extractor = build_extractor(paths, plan)
+        _column_plans[plan_key] = (paths, plan, extractor)
+        logging.debug(f"Built the column plan of survey {plan_key}: {len(plan)} columns")
+    return (plan, extractor)
+
+
+def flatten_survey_entries(survey_key, entries):
+    """
+    Return a DataFrame of the entries of one survey, with one column per
+    field of its column plan, read directly from the documents. Only the
+    dicts of an entry are walked; the answers of each are read at once.
+    Entries with keys that the plan does not know extend it.
+    """
+    entries_by_version = {}
+    for entry in entries:
+        entries_by_version.setdefault(entry['data'].get('version'), []).append(entry)
+
+    frames = []
+    for (version, version_entries) in entries_by_version.items():
+        (plan, extractor) = get_column_plan(survey_key, version)
+        rows = []
+        unknown = []
+        for entry in version_entries:
+            row = []
+            if not extract_row(extractor, entry, row):
+                unknown.append(entry)
+            rows.append(row)
+        if unknown:
+            (plan, extractor) = get_column_plan(survey_key, version, unknown)
+            rows = []
+            for entry in version_entries:
+                row = []
+                extract_row(extractor, entry, row)
+                rows.append(row)
+        names = {path: name for (name, path) in plan}
+        df = pd.DataFrame(rows, columns=[names[path] for path in extractor['paths']],
+                          index=range(len(version_entries)))
+        df = df[[name for (name, _) in plan]]
+        for col in constants.BINARY_DEMOGRAPHICS_COLS:
+            if col in df.columns:
+                df[col] = df[col].apply(str)
+        frames.append(df)
+
+    if not frames:
+        return pd.DataFrame()
+    if len(frames) == 1:
+        return frames[0]
+    return pd.concat(frames, ignore_index=True)
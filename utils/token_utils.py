@@ -0,0 +1,82 @@
+# token_utils.py
+import logging
+import threading
+
+import emcommon.auth.opcode as emcao
+import emission.storage.decorations.token_queries as esdt
+
+from utils import db_utils
+from utils.cache_utils import get_disk_cache
+
+# Number of tokens generated, checked and inserted at a time
+TOKEN_GENERATION_CHUNK = 5000
+# Attempts at replacing the tokens of a chunk that collide with existing
+# ones; collisions are very unlikely, so running out of attempts means the
+# token format leaves too few possible tokens
+TOKEN_GENERATION_ATTEMPTS = 10
+
+# The list of tokens is cached by each process, along with the version it
+# was loaded at. The version is a counter shared by all processes, bumped
+# whenever tokens are generated, and the number of tokens in the token db,
+# which also catches tokens inserted outside of the dashboard.
+_tokens_cache = {'version': None, 'tokens': []}
+_tokens_cache_lock = threading.Lock()
+_tokens_versions = get_disk_cache('tokens')
+
+
+def bump_tokens_version():
+    _tokens_versions.incr('version', default=0)
+
+
+def get_tokens_version():
+    return [_tokens_versions.get('version', default=0), db_utils.count_tokens()]
+
+
+def get_all_tokens():
+    """
+    Return the list of all the tokens, reloaded from the token db only if
+    its version changed since it was cached
+    """
+    version = get_tokens_version()
+    with _tokens_cache_lock:
+        if _tokens_cache['version'] != version:
+            logging.debug(f"Loading the tokens at version {version}")
+            _tokens_cache['tokens'] = esdt.get_all_tokens()
+            _tokens_cache['version'] = version
+        return _tokens_cache['tokens']
+
+
+def generate_unique_tokens(token_count, prefix, program, subgroup, token_length):
+    """
+    Generate and insert token_count new tokens, TOKEN_GENERATION_CHUNK at a
+    time, yielding the tokens inserted for each chunk.
+    Candidates that are duplicated in the chunk, or that already exist in the
+    token db, are replaced by new ones before inserting.
+    """
+    try:
+        yield from _generate_unique_tokens(token_count, prefix, program, subgroup, token_length)
+    finally:
+        bump_tokens_version()
+
+
+def _generate_unique_tokens(token_count, prefix, program, subgroup, token_length):
+    remaining = token_count
+    while remaining > 0:
+        chunk_size = min(remaining, TOKEN_GENERATION_CHUNK)
+        inserted = []
+        for _ in range(TOKEN_GENERATION_ATTEMPTS):
+            candidates = set()
+            while len(candidates) < chunk_size - len(inserted):
+                candidates.add(emcao.generate_opcode(prefix, program, subgroup, token_length))
+            candidates -= set(inserted)
+            candidates -= db_utils.query_existing_tokens(candidates)
+            inserted += db_utils.insert_new_tokens(list(candidates))
+            if len(inserted) == chunk_size:
+                break
+        else:
+            logging.warning(f"Could only generate {len(inserted)} of {chunk_size} unique tokens")
+            if inserted:
+                yield inserted
+            return
+        remaining -= chunk_size
+        yield inserted